@@ -0,0 +1,455 @@
+"""Benchmarks for the bot's hot paths.
+
+Runs bot.py inside a throwaway data/ folder filled with synthetic users,
+with the Telegram API stubbed out and Groq / pollinations replaced by a
+local fake server, then reports throughput, p50/p99 latency and bytes
+written for each scenario (growth of data/ on disk for SQLite).
+
+    python bench.py                         # 10k users, every scenario
+    python bench.py --users 1000000 --backend sqlite
+    python bench.py --scenarios dm,start --ops 5000 --upstream-latency 50
+    python bench.py --out bench_output.txt
+
+Rate limits are lifted so every op does real work instead of bouncing
+off a token bucket, except in help_buttons, which checks that clicks from
+different users never get throttled.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+ADMIN_ID = 8153349947
+BOT_USER = {"id": 7_000_000_000, "is_bot": True, "first_name": "Collins AI", "username": "Collins_X_Batman_bot"}
+SCENARIOS = [
+    "start", "leaderboard", "squad_leaderboard", "train", "group", "help_buttons", "lyrics", "dm", "image",
+    "broadcast",
+]
+REAL_RATE_LIMITS = {}  # the bot's own limits, saved before main() lifts them
+VERSES = {
+    "Naruto": ["Naruto Uzumaki", "Sasuke Uchiha", "Kakashi Hatake", "Itachi Uchiha"],
+    "DBZ": ["Goku", "Vegeta", "Gohan", "Piccolo"],
+    "One Piece": ["Luffy", "Zoro", "Nami", "Sanji"],
+}
+
+
+# ---------------- SYNTHETIC DATA ---------------- #
+def user_id(i):
+    return 6_000_000_000 + i
+
+def make_dataset(folder, users, seed=1):
+    """Write data/*.json the way the bot keeps them, for `users` users."""
+    rng = random.Random(seed)
+    data = os.path.join(folder, "data")
+    os.makedirs(data, exist_ok=True)
+
+    def dump(name, obj):
+        with open(os.path.join(data, name), "w") as f:
+            json.dump(obj, f)
+
+    def character():
+        verse = rng.choice(list(VERSES))
+        return {
+            "name": rng.choice(VERSES[verse]),
+            "verse": verse,
+            "level": rng.randint(1, 40),
+            "rarity": rng.choice(["Common", "Common", "Rare", "Legendary"]),
+            "stats": {"attack": rng.randint(10, 99), "speed": rng.randint(10, 99), "chakra": rng.randint(10, 99)},
+        }
+
+    uids = [str(user_id(i)) for i in range(users)]
+    dump("xp.json", {
+        f"user{i}": {"xp": rng.randint(0, 20000), "messages": rng.randint(0, 500), "commands": rng.randint(0, 500)}
+        for i in range(users)
+    })
+    dump("referrals.json", {uid: {"referrals": [], "coins": rng.randint(0, 100)} for uid in uids})
+    dump("anime_data.json", {
+        uid: {"characters": [character() for _ in range(rng.randint(1, 5))], "last_train": 0}
+        for uid in uids
+    })
+    dump("user_memory.json", {f"user{i}": [f"message {n}" for n in range(5)] for i in range(0, users, 10)})
+    dump("verified.json", uids)
+    dump("chats.json", [int(uid) for uid in uids])
+    dump("admins.json", [ADMIN_ID])
+    dump("banned_users.json", [])
+    dump("daily.json", {})
+    dump("warnings.json", {})
+
+def folder_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path) for f in files
+    )
+
+
+# ---------------- FAKE UPSTREAMS ---------------- #
+FAKE_IMAGE = bytes(random.Random(7).getrandbits(8) for _ in range(20_000))
+# Shaped like an AZLyrics page: ads and scripts, the unmarked lyrics div after
+# <div class="ringtone">, then a long tail the extractor should never parse
+FAKE_LYRICS_PAGE = (
+    "<html><head><script>" + "var ad = 1;" * 2000 + "</script></head><body>"
+    '<div class="ringtone"><a href="#">Ringtone</a></div>'
+    "<div>\n" + "<br>\n".join(f"Benchmark verse line {n}" for n in range(60)) + "\n</div>"
+    + "<div class=\"comments\">" + "<p>comment</p>" * 3000 + "</div></body></html>"
+).encode()
+
+def start_fake_upstreams(latency):
+    """Local Groq + pollinations stand-in; returns its base URL."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            # headers and body go out as separate writes; don't let Nagle hold the body back
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, body, content_type):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            answer = {"choices": [{"message": {"content": "Benchmark answer 🤖"}}]}
+            self.reply(json.dumps(answer).encode(), "application/json")
+
+        def do_GET(self):
+            if self.path.startswith("/lyrics/"):
+                self.reply(FAKE_LYRICS_PAGE, "text/html; charset=utf-8")
+            else:
+                self.reply(FAKE_IMAGE, "image/jpeg")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+# ---------------- FAKE TELEGRAM ---------------- #
+class FakeTelegram:
+    """Replaces the TeleBot methods that would hit api.telegram.org."""
+
+    METHODS = [
+        "send_message", "reply_to", "edit_message_text", "send_photo", "answer_callback_query",
+        "delete_message", "restrict_chat_member", "set_webhook", "delete_webhook",
+    ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.replies = {}  # (chat id, message id) -> time of reply_to, ("photo", chat id) -> send_photo
+        self.ids = itertools.count(1)
+
+    def install(self, telebot):
+        fake = self
+
+        def sender(name):
+            def method(bot, *args, **kwargs):
+                with fake.lock:
+                    fake.calls += 1
+                    if name == "reply_to":
+                        message = args[0]
+                        fake.replies[(message.chat.id, message.message_id)] = time.perf_counter()
+                    elif name == "send_photo":
+                        fake.replies[("photo", args[0])] = time.perf_counter()
+                chat_id = args[0] if args and isinstance(args[0], int) else 0
+                return types.SimpleNamespace(
+                    message_id=next(fake.ids),
+                    chat=types.SimpleNamespace(id=chat_id),
+                    photo=[types.SimpleNamespace(file_id=f"file{chat_id}")],
+                )
+            return method
+
+        for name in self.METHODS:
+            setattr(telebot.TeleBot, name, sender(name))
+        telebot.TeleBot.get_chat = lambda bot, chat_id: types.SimpleNamespace(
+            id=chat_id, username=f"user{chat_id}", first_name="Bench"
+        )
+        telebot.TeleBot.get_chat_member = lambda bot, chat_id, user_id: types.SimpleNamespace(status="member")
+        telebot.TeleBot.get_chat_administrators = lambda bot, chat_id: []
+
+    def wait_for_replies(self, keys, timeout=300):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if all(k in self.replies for k in keys):
+                    return [self.replies[k] for k in keys]
+            time.sleep(0.01)
+        raise TimeoutError(f"only {sum(k in self.replies for k in keys)}/{len(keys)} replies arrived")
+
+
+message_ids = itertools.count(1)
+
+def make_message(telebot, text, uid, chat_id=None, chat_type="private", username=None):
+    data = {
+        "message_id": next(message_ids),
+        "date": int(time.time()),
+        "text": text,
+        "from": {"id": uid, "is_bot": False, "first_name": "Bench", "username": username or f"user{uid}"},
+        "chat": {"id": chat_id or uid, "type": chat_type},
+    }
+    if text.startswith("/"):
+        data["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return telebot.types.Message.de_json(data)
+
+def make_callback(telebot, data, uid):
+    """uid pressing a button under a message the bot sent them."""
+    return telebot.types.CallbackQuery.de_json({
+        "id": str(next(message_ids)),
+        "chat_instance": "bench",
+        "data": data,
+        "from": {"id": uid, "is_bot": False, "first_name": "Bench", "username": f"user{uid}"},
+        "message": {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "text": "📖 Help menu",
+            "from": BOT_USER,
+            "chat": {"id": uid, "type": "private"},
+        },
+    })
+
+
+# ---------------- SCENARIOS ---------------- #
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q / 100))]
+
+def run_sync(handler, messages, concurrency):
+    """Call handler on each message from `concurrency` threads, like telebot's pool."""
+    def timed(message):
+        started = time.perf_counter()
+        handler(message)
+        return time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(timed, messages))
+
+def scenario(name, bot, telegram, telebot, args):
+    """Returns (ops, latencies in seconds)."""
+    rng = random.Random(name)
+    users = args.users
+    ops = args.ops
+    pick = lambda: user_id(rng.randrange(users))
+
+    if name == "start":
+        messages = [
+            make_message(telebot, f"/start {pick()}" if i % 3 == 0 else "/start",
+                         user_id(users + i) if i % 2 else pick())
+            for i in range(ops)
+        ]
+        return ops, run_sync(bot.start, messages, args.concurrency)
+
+    if name == "leaderboard":
+        messages = [make_message(telebot, "/leaderboard", pick()) for _ in range(ops)]
+        return ops, run_sync(bot.leaderboard, messages, args.concurrency)
+
+    if name == "squad_leaderboard":
+        messages = [make_message(telebot, "/squad_leaderboard", pick()) for _ in range(ops)]
+        return ops, run_sync(bot.squad_leaderboard, messages, args.concurrency)
+
+    if name == "train":
+        # everyone can train once, so use distinct users
+        uids = rng.sample(range(users), min(ops, users))
+        messages = [make_message(telebot, "/train", user_id(i)) for i in uids]
+        return len(messages), run_sync(bot.train_characters, messages, args.concurrency)
+
+    if name == "group":
+        texts = ["gm everyone", "who is online?", "check https://spam.example", "lol", "join t.me/spam"]
+        messages = [
+            make_message(telebot, rng.choice(texts), pick(), chat_id=-1000 - rng.randrange(50), chat_type="supergroup")
+            for _ in range(ops)
+        ]
+        return ops, run_sync(bot.group_link_moderation, messages, args.concurrency)
+
+    if name == "help_buttons":
+        # Distinct users under the real limits: any throttling here means
+        # clicks are sharing a bucket they shouldn't
+        uids = rng.sample(range(users), min(ops, users))
+        calls = [make_callback(telebot, "help_leaderboard", user_id(i)) for i in uids]
+        lifted = dict(bot.RATE_LIMITS)
+        bot.RATE_LIMITS.update(REAL_RATE_LIMITS)
+        limited = bot.rate_buckets.limited
+        try:
+            latencies = run_sync(bot.help_callback, calls, args.concurrency)
+        finally:
+            bot.RATE_LIMITS.update(lifted)
+        if bot.rate_buckets.limited > limited:
+            print(f"   ⚠ throttled {bot.rate_buckets.limited - limited} times though every click came from a different user")
+        return len(calls), latencies
+
+    if name == "lyrics":
+        # 50 songs asked for over and over, spelled differently, so most
+        # lookups should be served from the normalized cache
+        songs = [(f"Bench Artist {n % 7}", f"Song Number {n}") for n in range(50)]
+        def text():
+            artist, title = rng.choice(songs)
+            if rng.random() < 0.5:
+                artist, title = artist.upper(), f"  {title.lower()} "
+            return f"/lyrics {artist} - {title}"
+        messages = [make_message(telebot, text(), pick()) for _ in range(ops)]
+        errors = bot.handler_stats.get("lyrics_cmd", {}).get("errors", 0)
+        latencies = run_sync(bot.lyrics_cmd, messages, args.concurrency)
+        failed = bot.handler_stats["lyrics_cmd"]["errors"] - errors
+        if failed:
+            print(f"   ⚠ {failed} /lyrics calls raised")
+        return ops, latencies
+
+    if name == "image":
+        # One chat per op so each send_photo matches its request; prompts
+        # repeat, so the disk / file_id cache paths get their share too
+        prompts = [f"anime city at night, variant {n}" for n in range(100)]
+        submitted = {}
+        for i in range(ops):
+            message = make_message(telebot, "/image", user_id(users + i))
+            prompt = rng.choice(prompts)
+            submitted[("photo", message.chat.id)] = time.perf_counter()
+            while not bot.images.submit(message, prompt, "🖼 AI Generated Image", "Image"):
+                time.sleep(0.001)  # queue full, retry like a patient user
+        keys = list(submitted)
+        sent = telegram.wait_for_replies(keys)
+        return ops, [done - submitted[k] for k, done in zip(keys, sent)]
+
+    if name == "dm":
+        messages = [make_message(telebot, f"question {i} for the bot", pick()) for i in range(ops)]
+        submitted = {}
+        for message in messages:
+            submitted[(message.chat.id, message.message_id)] = time.perf_counter()
+            bot.handle_private_dm(message)
+        keys = list(submitted)
+        answered = telegram.wait_for_replies(keys)
+        return ops, [done - submitted[k] for k, done in zip(keys, answered)]
+
+    if name == "broadcast":
+        sends = []
+        send = bot.broadcast_send
+
+        def timed_send(chat_id, text):
+            started = time.perf_counter()
+            try:
+                return send(chat_id, text)
+            finally:
+                sends.append(time.perf_counter() - started)
+
+        bot.broadcast_send = timed_send
+        try:
+            bot.broadcast(make_message(telebot, "/broadcast Benchmark news", ADMIN_ID))
+            while not bot.broadcast_job.get("finished"):
+                time.sleep(0.05)
+        finally:
+            bot.broadcast_send = send
+        return len(sends), sends
+
+    raise ValueError(f"unknown scenario {name}")
+
+
+# ---------------- MAIN ---------------- #
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000, help="synthetic users (10k-1M)")
+    parser.add_argument("--ops", type=int, default=2_000, help="operations per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads calling sync handlers")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated subset of " + ",".join(SCENARIOS))
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--upstream-latency", type=float, default=0, help="fake Groq/pollinations delay in ms")
+    parser.add_argument("--keep", action="store_true", help="keep the temp data folder")
+    parser.add_argument("--out", help="also write the report to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="collins-bench-")
+    print(f"📦 Generating {args.users} users in {workdir} ...")
+    started = time.perf_counter()
+    make_dataset(workdir, args.users)
+    print(f"   done in {time.perf_counter() - started:.1f}s ({folder_size(workdir) // 1024} KB)")
+
+    os.environ.update({
+        "TELEGRAM_TOKEN": "123456:BENCH",
+        "STORAGE_BACKEND": args.backend,
+        "BROADCAST_RATE": "1000000",
+        "GROQ_RPM": "100000000",
+    })
+    import telebot
+    telegram = FakeTelegram()
+    telegram.install(telebot)
+    upstream = start_fake_upstreams(args.upstream_latency / 1000)
+
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+    started = time.perf_counter()
+    import bot
+    import_time = time.perf_counter() - started
+    bot.data_ready.wait()
+    load_time = time.perf_counter() - started
+    bot.GROQ_URL = f"{upstream}/openai/v1/chat/completions"
+    bot.POLLINATIONS_URL = f"{upstream}/prompt/"
+    bot.AZLYRICS_URL = f"{upstream}/lyrics/"
+    REAL_RATE_LIMITS.update(bot.RATE_LIMITS)
+    for command in bot.RATE_LIMITS:
+        bot.RATE_LIMITS[command] = (1e9, 1e9)
+
+    # JSON: bytes the flusher wrote out. SQLite rewrites pages in place and
+    # through the WAL, so there the honest number is how much data/ grew.
+    data_dir = os.path.join(workdir, "data")
+    if args.backend == "sqlite":
+        written_label, bytes_written = "disk growth", lambda: folder_size(data_dir)
+    else:
+        written_label, bytes_written = "bytes written", lambda: bot.persist_stats["bytes_written"]
+
+    rows = []
+    for name in args.scenarios.split(","):
+        bot.flush_dirty()
+        before_bytes = bytes_written()
+        started = time.perf_counter()
+        ops, latencies = scenario(name, bot, telegram, telebot, args)
+        bot.flush_dirty()
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        rows.append((
+            name, ops, elapsed, ops / elapsed if elapsed else 0,
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+            bytes_written() - before_bytes,
+        ))
+        print(f"   {name}: {ops} ops in {elapsed:.2f}s")
+
+    lines = [
+        f"Collins AI benchmark | users={args.users} ops={args.ops} backend={args.backend} "
+        f"concurrency={args.concurrency} upstream_latency={args.upstream_latency}ms",
+        f"startup: import bot {import_time * 1000:.0f} ms | data loaded {load_time * 1000:.0f} ms",
+        "",
+        f"{'scenario':<18}{'ops':>8}{'secs':>9}{'ops/s':>11}{'p50 ms':>10}{'p99 ms':>10}{written_label:>15}",
+    ]
+    for name, ops, elapsed, rate, p50, p99, written in rows:
+        lines.append(f"{name:<18}{ops:>8}{elapsed:>9.2f}{rate:>11.0f}{p50:>10.2f}{p99:>10.2f}{written:>15}")
+    lines += ["", f"data/ on disk: {folder_size(data_dir) // 1024} KB | Telegram calls: {telegram.calls}"]
+
+    report = "\n".join(lines)
+    print("\n" + report)
+    if args.out:
+        with open(os.path.join(REPO, args.out) if not os.path.isabs(args.out) else args.out, "w") as f:
+            f.write(report + "\n")
+
+    if not args.keep:
+        os.chdir(REPO)
+        shutil.rmtree(workdir, ignore_errors=True)
+    os._exit(0)  # the bot's worker threads are daemons, don't wait on them
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,39 @@
+import time
+BOOT_CLOCK = time.perf_counter()  # startup timing report starts here
+
 import os
 import json
 import re
+import sqlite3
+import atexit
+import bisect
+import heapq
+import hashlib
+import hmac
+import functools
+import inspect
+import gzip
+import shutil
+import signal
+import tempfile
 import requests
+import queue
 import threading
-import time
-from io import BytesIO
 import random
 from telebot.types import Message
 from datetime import datetime
 from typing import Optional
-from bs4 import BeautifulSoup
+from urllib.parse import urlparse
+from html.parser import HTMLParser
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from dotenv import load_dotenv
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-from deep_translator import GoogleTranslator
-
+# deep_translator and flask are imported on first use (see TranslationService
+# and make_app), they're a good chunk of the cold start.
 
+IMPORT_SECONDS = time.perf_counter() - BOOT_CLOCK
 START_TIME = time.time()  # bot start time
 
 # Load environment variables
@@ -37,24 +55,413 @@ WARNINGS_FILE = "data/warnings.json"
 MUTED_FILE = "data/muted.json"
 REFERRAL_FILE = "data/referrals.json"
 DAILY_FILE = "data/daily.json"
+ANIME_FILE = "data/anime_data.json"
+LYRICS_FILE = "data/lyrics.json"
+USERNAMES_FILE = "data/usernames.json"
+DB_FILE = "data/collins.db"
+
+# "json" (default) keeps the data/*.json files, "sqlite" uses DB_FILE
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+
+
+# ---------------- PERSISTENCE ---------------- #
+# save_json() doesn't touch the disk, it only marks the file dirty.
+# A background flusher writes dirty files in one batch every PERSIST_INTERVAL
+# seconds (or sooner once PERSIST_MAX_PENDING saves pile up), so a burst of
+# messages costs one write per file instead of one per message.
+PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL", "2"))
+PERSIST_MAX_PENDING = int(os.getenv("PERSIST_MAX_PENDING", "200"))
+
+persist_lock = threading.Lock()   # guards dirty_files / pending_saves
+flush_lock = threading.Lock()     # only one flush at a time
+flush_wakeup = threading.Event()
+dirty_files = {}                  # file -> (data, indent)
+pending_saves = 0
+persist_stats = {"flushes": 0, "files_written": 0, "bytes_written": 0, "errors": 0}
+
+def write_json_atomic(file, data, indent=2):
+    """Write JSON to a temp file next to `file` and rename it into place."""
+    folder = os.path.dirname(file) or "."
+    os.makedirs(folder, exist_ok=True)
+    payload = json.dumps(data, indent=indent, default=list).encode()  # deques/sets as lists
+
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, file)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return len(payload)
+
+def flush_dirty():
+    """Write every dirty file now. Returns the number of bytes written."""
+    global pending_saves
+    with flush_lock:
+        with persist_lock:
+            batch = dict(dirty_files)
+            dirty_files.clear()
+            pending_saves = 0
+
+        if not batch:
+            return 0
+
+        written = 0
+        for file, (data, indent) in batch.items():
+            try:
+                written += write_json_atomic(file, data, indent)
+                persist_stats["files_written"] += 1
+            except Exception as e:
+                # RuntimeError = a handler changed the dict mid-dump, just retry next round
+                if not isinstance(e, RuntimeError):
+                    print(f"Persist error ({file}): {e}")
+                    persist_stats["errors"] += 1
+                with persist_lock:
+                    dirty_files.setdefault(file, (data, indent))
+
+        persist_stats["flushes"] += 1
+        persist_stats["bytes_written"] += written
+        return written
+
+def persist_loop():
+    while True:
+        flush_wakeup.wait(PERSIST_INTERVAL)
+        flush_wakeup.clear()
+        flush_dirty()
+
+shutdown_hooks = []  # extra flushes (stores with their own files) run on exit
+
+def shutdown(signum=None, frame=None):
+    print("💾 Flushing data before exit...")
+    flush_dirty()
+    for hook in shutdown_hooks:
+        try:
+            hook()
+        except Exception as e:
+            print(f"Shutdown hook error: {e}")
+    if signum is not None:
+        os._exit(0)
+
+def handle_signals():
+    """Flush on SIGTERM/SIGINT. Called from main() only, so importing bot
+    (bench.py, gunicorn) leaves the host's own handlers alone."""
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+threading.Thread(target=persist_loop, daemon=True).start()
+atexit.register(shutdown)
 
-def save_verified():
-    save_json(VERIFIED_FILE, verified_users)
 # ---------------- HELPERS ---------------- #
 def load_json(file, default):
+    # A pending (not yet flushed) save is newer than what's on disk
+    with persist_lock:
+        if file in dirty_files:
+            return dirty_files[file][0]
     if os.path.exists(file):
         with open(file) as f:
             return json.load(f)
     return default
 
-def save_json(file, data):
-    os.makedirs(os.path.dirname(file), exist_ok=True)
-    with open(file, "w") as f:
-        json.dump(data, f, indent=2)
+def save_json(file, data, indent=2):
+    global pending_saves
+    with persist_lock:
+        dirty_files[file] = (data, indent)
+        pending_saves += 1
+        if pending_saves >= PERSIST_MAX_PENDING:
+            flush_wakeup.set()
+
+def save_referrals(*uids):
+    """Persist the given referral records together (one transaction on SQLite)."""
+    db.put_many("referrals", {uid: referrals_data[uid] for uid in uids})
+
+TELEGRAM_MAX_CHARS = 4096
+
+def split_message(text, limit=TELEGRAM_MAX_CHARS):
+    """Cut text into Telegram-sized pieces, on line breaks where possible."""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        chunks.append(text)
+    return chunks
+
+RARITY_BONUS = {"Common": 1, "Rare": 3, "Legendary": 7}
+
+def squad_strength(characters):
+    return sum(c["level"] + RARITY_BONUS.get(c["rarity"], 0) for c in characters)
+
+# ---------------- STORAGE BACKENDS ---------------- #
+# Handlers keep mutating the in-memory dicts; they tell the repository
+# which record changed with db.put()/db.delete()/db.put_many()/db.put_all().
+# store: (json file, container type, json indent, indexed score for SQL)
+STORES = {
+    "xp": (XP_FILE, dict, 2, lambda v: v["xp"]),
+    "referrals": (REFERRAL_FILE, dict, 4, lambda v: v["coins"]),
+    "memory": (MEMORY_FILE, dict, 2, None),
+    "anime": (ANIME_FILE, dict, 4, lambda v: squad_strength(v["characters"])),
+    "daily": (DAILY_FILE, dict, 2, None),
+    "verified": (VERIFIED_FILE, set, 2, None),
+    "banned": (BANNED_FILE, set, 2, None),
+    "lyrics": (LYRICS_FILE, dict, 2, None),
+    "usernames": (USERNAMES_FILE, dict, 2, None),
+}
+
+class JsonRepository:
+    """Whole-file JSON stores, written through the write-behind flusher."""
+    incremental = False
+
+    def __init__(self):
+        self.stores = {}
+
+    def load(self, store):
+        file, kind, _, _ = STORES[store]
+        self.stores[store] = kind(load_json(file, kind()))
+        return self.stores[store]
+
+    def _save(self, store):
+        file, kind, indent, _ = STORES[store]
+        data = self.stores[store]
+        save_json(file, list(data) if kind is set else data, indent=indent)
+
+    def put(self, store, key, value=None):
+        self._save(store)
+
+    def delete(self, store, key):
+        self._save(store)
+
+    def put_many(self, store, items):
+        self._save(store)
+
+    def put_all(self, changes):
+        for store in changes:
+            self._save(store)
+
+    def top(self, store, n=10):
+        """Highest-score keys, scanning the in-memory dict."""
+        score = STORES[store][3]
+        scored = ((k, score(v)) for k, v in self.stores[store].items())
+        return heapq.nlargest(n, (row for row in scored if row[1] > 0), key=lambda row: row[1])
+
+class SQLiteRepository:
+    """One table per store: (key, score, value) with score indexed.
+
+    Runs in WAL mode so reads never wait on writes; put_many() and
+    put_all() are a single transaction. On first start the existing data/*.json files are migrated.
+    """
+    incremental = True
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        for store, (_, _, _, score) in STORES.items():
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {store} "
+                "(key TEXT PRIMARY KEY, score INTEGER, value TEXT)"
+            )
+            if score:
+                self.conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {store}_score ON {store} (score DESC)"
+                )
+        self.migrate_json()
+
+    def _row(self, store, key, value):
+        score = STORES[store][3]
+        return (
+            str(key),
+            score(value) if score and value is not None else None,
+            json.dumps(value) if value is not None else None,
+        )
+
+    def _write(self, tables):
+        """Upsert {store: rows} in one transaction."""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                for store, rows in tables.items():
+                    self.conn.executemany(
+                        f"INSERT OR REPLACE INTO {store} (key, score, value) VALUES (?, ?, ?)", rows
+                    )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        persist_stats["bytes_written"] += sum(len(r[2] or "") for rows in tables.values() for r in rows)
+
+    def migrate_json(self):
+        """One-shot import of data/*.json (skipped once it has run)."""
+        done = self.conn.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+        if done:
+            return
+
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                for store, (file, kind, _, _) in STORES.items():
+                    data = load_json(file, kind())
+                    if isinstance(data, dict):
+                        rows = [self._row(store, k, v) for k, v in data.items()]
+                    else:
+                        rows = [self._row(store, k, None) for k in data]
+                    self.conn.executemany(
+                        f"INSERT OR REPLACE INTO {store} (key, score, value) VALUES (?, ?, ?)", rows
+                    )
+                    print(f"🗄 Migrated {len(rows)} {store} records to SQLite")
+                self.conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('migrated', ?)", (str(time.time()),)
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def load(self, store):
+        kind = STORES[store][1]
+        with self.lock:
+            rows = self.conn.execute(f"SELECT key, value FROM {store}").fetchall()
+        if kind is dict:
+            return {k: json.loads(v) for k, v in rows}
+        return kind(k for k, _ in rows)
+
+    def get(self, store, key):
+        with self.lock:
+            row = self.conn.execute(f"SELECT value FROM {store} WHERE key = ?", (str(key),)).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def put(self, store, key, value=None):
+        self._write({store: [self._row(store, key, value)]})
+
+    def delete(self, store, key):
+        with self.lock:
+            self.conn.execute(f"DELETE FROM {store} WHERE key = ?", (str(key),))
+
+    def put_many(self, store, items):
+        self._write({store: [self._row(store, k, v) for k, v in items.items()]})
+
+    def put_all(self, changes):
+        """{store: {key: value}} across several stores, one transaction."""
+        self._write({
+            store: [self._row(store, k, v) for k, v in items.items()]
+            for store, items in changes.items()
+        })
+
+    def top(self, store, n=10):
+        """Highest-score keys straight off the score index."""
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT key, score FROM {store} WHERE score > 0 ORDER BY score DESC LIMIT ?", (n,)
+            ).fetchall()
+
+if STORAGE_BACKEND == "sqlite":
+    os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
+    db = SQLiteRepository(DB_FILE)
+else:
+    db = JsonRepository()
+
+# Referral credit, daily bonus etc. touch several fields at once
+data_lock = threading.RLock()
+
+# ---------------- RANKINGS ---------------- #
+class RankIndex:
+    """Keys ordered by score (highest first) for top-N and rank lookups.
+
+    Entries sit in short sorted buckets, so an update is two bisects and a
+    small list insert no matter how many users there are.
+    """
+    BUCKET_SIZE = 512
+
+    def __init__(self, items=()):
+        self.lock = threading.Lock()
+        self.scores = {}    # key -> score
+        self.buckets = []   # sorted lists of (-score, key)
+        self.maxes = []     # last entry of each bucket
+        for key, score in items:
+            self._insert(str(key), score)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __contains__(self, key):
+        return str(key) in self.scores
+
+    def update(self, key, score):
+        key = str(key)
+        with self.lock:
+            if self.scores.get(key) == score:
+                return
+            self._remove(key)
+            self._insert(key, score)
+
+    def discard(self, key):
+        with self.lock:
+            self._remove(str(key))
+
+    def _insert(self, key, score):
+        entry = (-score, key)
+        self.scores[key] = score
+        if not self.buckets:
+            self.buckets.append([entry])
+            self.maxes.append(entry)
+            return
 
-def save_referrals():
-    with open(REFERRAL_FILE, "w") as f:
-        json.dump(referrals_data, f, indent=4)
+        i = min(bisect.bisect_left(self.maxes, entry), len(self.buckets) - 1)
+        bucket = self.buckets[i]
+        bisect.insort(bucket, entry)
+        self.maxes[i] = bucket[-1]
+
+        if len(bucket) > 2 * self.BUCKET_SIZE:
+            half = len(bucket) // 2
+            self.buckets.insert(i + 1, bucket[half:])
+            del bucket[half:]
+            self.maxes[i] = bucket[-1]
+            self.maxes.insert(i + 1, self.buckets[i + 1][-1])
+
+    def _remove(self, key):
+        score = self.scores.pop(key, None)
+        if score is None:
+            return
+        entry = (-score, key)
+        i = bisect.bisect_left(self.maxes, entry)
+        bucket = self.buckets[i]
+        del bucket[bisect.bisect_left(bucket, entry)]
+        if bucket:
+            self.maxes[i] = bucket[-1]
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+
+    def top(self, n=10):
+        """[(key, score)] for the n highest scores."""
+        out = []
+        with self.lock:
+            for bucket in self.buckets:
+                for neg, key in bucket:
+                    out.append((key, -neg))
+                    if len(out) == n:
+                        return out
+        return out
+
+    def rank(self, key):
+        """1-based position of `key`, or None if it isn't ranked."""
+        key = str(key)
+        with self.lock:
+            score = self.scores.get(key)
+            if score is None:
+                return None
+            entry = (-score, key)
+            i = bisect.bisect_left(self.maxes, entry)
+            before = sum(len(b) for b in self.buckets[:i])
+            return before + bisect.bisect_left(self.buckets[i], entry) + 1
 
 TIER_REWARDS = {
     5: {"coins": 50, "badge": "🥉"},
@@ -70,55 +477,180 @@ SHOP_ITEMS = {
 }
 
 def check_tiers(uid):
+    """Pay out a tier reward reached by uid; returns the messages to send them."""
     data = referrals_data[uid]
     total = len(data["referrals"])
+    notices = []
 
     for tier, reward in TIER_REWARDS.items():
         if total == tier:
             data["coins"] += reward["coins"]
-            bot.send_message(
-                uid,
+            notices.append(
                 f"🎉 TIER UNLOCKED!\n"
                 f"{tier} referrals reached!\n"
                 f"+{reward['coins']} coins\n"
                 f"Badge unlocked: {reward['badge']}"
             )
+    return notices
+
+def send_notices(notices):
+    """Send (chat_id, text) pairs; one failing (blocked bot, 403) doesn't stop the rest."""
+    for chat_id, text in notices:
+        try:
+            bot.send_message(chat_id, text)
+        except Exception as e:
+            print(f"Notify {chat_id} error: {e}")
 
-daily_data = load_json(DAILY_FILE, {})
+daily_data = None  # loaded by load_data()
 
 def daily_bonus(uid):
     today = datetime.now().strftime("%Y-%m-%d")
-    last = daily_data.get(uid)
 
-    if last != today:
-        daily_data[uid] = today
-        referrals_data[uid]["coins"] += 5
-        save_json(DAILY_FILE,daily_data)
-        save_referrals()
-        return True
-    return False
+    with data_lock:
+        last = daily_data.get(uid)
 
-# -------------------- INITIALIZE FILE -------------------- #
-# Create data/referrals.json if it doesn't exist
-if not os.path.exists("data"):
-    os.makedirs("data")  # make the data folder if missing
-
-if not os.path.exists(REFERRAL_FILE):
-    with open(REFERRAL_FILE, "w") as f:
-        json.dump({}, f, indent=4)
+        if last != today:
+            daily_data[uid] = today
+            referrals_data[uid]["coins"] += 5
+            db.put_all({"daily": {uid: today}, "referrals": {uid: referrals_data[uid]}})
+            return True
+    return False
 
 # -------------------- LOAD DATA -------------------- #
-with open(REFERRAL_FILE, "r") as f:
-    referrals_data = json.load(f)
+referrals_data = None  # loaded by load_data()
+
+# ---------------- ACTIVITY LOG ---------------- #
+# One JSON object per line in ACTIVITY_FILE, written in batches by a
+# background thread. The file is rotated by size or age into gzipped
+# archives next to it, and only the newest ACTIVITY_KEEP are kept.
+ACTIVITY_FILE = "data/activity.jsonl"
+ACTIVITY_MAX_BYTES = 10 * 1024 * 1024
+ACTIVITY_MAX_AGE = 24 * 3600
+ACTIVITY_KEEP = 14
+ACTIVITY_QUEUE = 10000
+ACTIVITY_BATCH = 500
+
+class ActivityLog:
+    def __init__(self, file):
+        self.file = file
+        self.queue = queue.Queue(maxsize=ACTIVITY_QUEUE)
+        self.dropped = 0
+        self.written = 0
+        self.lock = threading.Lock()  # one writer at a time (thread or shutdown flush)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        self.opened = os.path.getmtime(file) if os.path.exists(file) else time.time()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def record(self, **fields):
+        """Queue one record; never blocks, drops it if the writer is behind."""
+        fields["ts"] = round(time.time(), 3)
+        try:
+            self.queue.put_nowait(fields)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self, first=None):
+        batch = [first] if first else []
+        while len(batch) < ACTIVITY_BATCH:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
 
-def log_user(message):
-    os.makedirs("data", exist_ok=True)
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open("data/users.log", "a") as f:
-        f.write(f"{now} | @{message.from_user.username} | {message.text}\n")
+    def _write(self, batch):
+        if not batch:
+            return
+        lines = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch)
+        with self.lock:
+            with open(self.file, "a", encoding="utf-8") as f:
+                f.write(lines)
+            self.written += len(batch)
+            if (os.path.getsize(self.file) > ACTIVITY_MAX_BYTES
+                    or time.time() - self.opened > ACTIVITY_MAX_AGE):
+                self._rotate()
+
+    def _rotate(self):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        base, ext = os.path.splitext(self.file)
+        rotated = f"{base}-{stamp}{ext}"
+        os.replace(self.file, rotated)
+        self.opened = time.time()
+        with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(rotated)
+
+        folder, prefix = os.path.split(base)
+        archives = sorted(f for f in os.listdir(folder) if f.startswith(prefix + "-") and f.endswith(".gz"))
+        for old in archives[:-ACTIVITY_KEEP]:
+            os.remove(os.path.join(folder, old))
+
+    def _run(self):
+        while True:
+            try:
+                self._write(self._drain(self.queue.get()))
+            except Exception as e:
+                print(f"⚠ Activity log error: {e}")
+                time.sleep(1)
+
+    def flush(self):
+        while not self.queue.empty():
+            self._write(self._drain())
+
+activity_log = ActivityLog(ACTIVITY_FILE)
+shutdown_hooks.append(activity_log.flush)
+
+def log_user(message, handler):
+    """Log one handled message. Inside an @instrument'ed handler the record is
+    written when the handler returns, with its run time as latency (message.date
+    only has whole seconds); elsewhere it is written now without one."""
+    fields = dict(
+        user=message.from_user.id,
+        username=message.from_user.username,
+        chat=message.chat.id,
+        handler=handler,
+        text=message.text,
+    )
+    if getattr(handler_context, "started", None) is not None:
+        handler_context.activity = fields
+    else:
+        activity_log.record(latency=None, **fields)
 
 CHANNEL_USERNAME = "@Collins_AI_101"  # without https
-verified_users = load_json(VERIFIED_FILE, [])
+JOINED_STATUSES = ["member", "administrator", "creator"]
+
+def send_access_locked(chat_id):
+    markup = InlineKeyboardMarkup()
+    markup.add(
+        InlineKeyboardButton("📢 Follow Channel", url=f"https://t.me/{CHANNEL_USERNAME[1:]}"),
+        InlineKeyboardButton("✅ Verify", callback_data="verify_join")
+    )
+    bot.send_message(
+        chat_id,
+        "🚫 *Access Locked!*\nJoin the channel first and verify to unlock commands!",
+        reply_markup=markup,
+        parse_mode="Markdown"
+    )
+
+def force_join(message):
+    """True if the user has joined the channel, else show the join/verify buttons.
+
+    Users who joined but never pressed Verify are checked once with
+    get_chat_member and verified on the spot.
+    """
+    uid = str(message.from_user.id)
+    if identity.is_verified(uid):
+        return True
+    try:
+        joined = bot.get_chat_member(CHANNEL_USERNAME, uid).status in JOINED_STATUSES
+    except Exception as e:
+        print(f"get_chat_member error: {e}")
+        joined = False
+    if joined:
+        identity.verify(uid)
+        return True
+    send_access_locked(message.chat.id)
+    return False
 
 # ---------------- VERIFY CALLBACK ---------------- #
 @bot.callback_query_handler(func=lambda call: call.data == "verify_join")
@@ -129,11 +661,9 @@ def verify_user(call):
         member = bot.get_chat_member(CHANNEL_USERNAME, uid)
 
         # ✅ User joined channel
-        if member.status in ["member", "administrator", "creator"]:
+        if member.status in JOINED_STATUSES:
 
-            if uid not in verified_users:
-                verified_users.append(uid)
-                save_verified()
+            identity.verify(uid)
 
             bot.edit_message_text(
                 "✅ *Verification successful!*\n\n"
@@ -158,39 +688,262 @@ def verify_user(call):
             show_alert=True
         )
 
+# ---------------- IDENTITY ---------------- #
+class IdentityIndex:
+    """Banned / verified / admin / known-chat sets, keyed by numeric id.
+
+    Usernames are only aliases since they change or are missing. A ban on
+    an @name we haven't seen yet is stored as "@name" and moved onto the
+    user's id the first time they talk to the bot. The last username seen
+    for each id is persisted so bans by id still cover username-keyed data
+    after a restart.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.banned = db.load("banned")      # str(uid) or "@username"
+        self.verified = db.load("verified")  # str(uid)
+        self.admins = set(load_json(ADMINS_FILE, []))
+        self.chats = set(load_json(CHATS_FILE, []))
+        self.names = db.load("usernames")  # str(uid) -> username
+        self.aliases = {name.lower(): uid for uid, name in self.names.items()}  # lowercase username -> str(uid)
+
+        # banned_users.json used to hold bare usernames
+        for key in [k for k in self.banned if not k.isdigit() and not k.startswith("@")]:
+            self.banned.discard(key)
+            db.delete("banned", key)
+            self.banned.add("@" + key.lower())
+            db.put("banned", "@" + key.lower())
+
+    def see(self, user):
+        """Record uid <-> username, settling any pending @name ban."""
+        if not user.username:
+            return
+        uid, name = str(user.id), user.username.lower()
+        if self.aliases.get(name) == uid:
+            return
+        with self.lock:
+            old = self.names.get(uid)
+            if old and self.aliases.get(old.lower()) == uid:
+                del self.aliases[old.lower()]
+            self.aliases[name] = uid
+            self.names[uid] = user.username
+            db.put("usernames", uid, user.username)
+            if "@" + name in self.banned:
+                self.banned.discard("@" + name)
+                db.delete("banned", "@" + name)
+                self.banned.add(uid)
+                db.put("banned", uid)
+
+    def resolve(self, target):
+        """'123' / '@name' / 'name' -> str(uid) if known, else '@name'."""
+        target = str(target).strip()
+        if target.isdigit():
+            return target
+        name = target.lstrip("@").lower()
+        return self.aliases.get(name, "@" + name)
+
+    def is_banned(self, *keys):
+        """True if any of the given ids / usernames is banned."""
+        for key in keys:
+            if key is None:
+                continue
+            key = str(key)
+            if key in self.banned:
+                return True
+            name = key.lstrip("@").lower()
+            if "@" + name in self.banned or self.aliases.get(name) in self.banned:
+                return True
+        return False
+
+    def ban(self, target):
+        key = self.resolve(target)
+        with self.lock:
+            self.banned.add(key)
+            db.put("banned", key)
+        return key
+
+    def unban(self, target):
+        key = self.resolve(target)
+        keys = {key, "@" + self.names.get(key, key).lstrip("@").lower()}
+        removed = False
+        with self.lock:
+            for k in keys & self.banned:
+                self.banned.discard(k)
+                db.delete("banned", k)
+                removed = True
+        return removed
+
+    def is_admin(self, uid):
+        return uid in self.admins
+
+    def add_admin(self, uid):
+        with self.lock:
+            self.admins.add(uid)
+            save_json(ADMINS_FILE, list(self.admins))
+
+    def is_verified(self, uid):
+        return str(uid) in self.verified
+
+    def verify(self, uid):
+        if str(uid) in self.verified:
+            return
+        with self.lock:
+            self.verified.add(str(uid))
+            db.put("verified", str(uid))
+
+    def add_chat(self, chat_id):
+        if chat_id in self.chats:
+            return
+        with self.lock:
+            self.chats.add(chat_id)
+            save_json(CHATS_FILE, list(self.chats))
+
+    def drop_chat(self, chat_id):
+        with self.lock:
+            if chat_id in self.chats:
+                self.chats.discard(chat_id)
+                save_json(CHATS_FILE, list(self.chats))
+
+    def xp_keys(self, key):
+        """XP is keyed by uid in some places and username in others."""
+        key = str(key)
+        return {key, self.names.get(key, key)}
+
 # ---------------- LOAD DATA ---------------- #
-user_memory = load_json(MEMORY_FILE, {})
-admins = set(load_json(ADMINS_FILE, []))
-banned_users = set(load_json(BANNED_FILE, []))
-xp_data = load_json(XP_FILE, {})
-chats = load_json(CHATS_FILE, [])
+# All of these are filled in by load_data() on a background thread
+user_memory = None
+identity = None
+xp_data = None
+xp_rank = None  # global XP ranking, banned users are kept out of it (see ban/unban)
 summarize_mode = {}
 admin_wait = {}
-link_warnings = {}
 
 # ---------------- ANIME GAME DATA ---------------- #
-ANIME_FILE = "data/anime_data.json"
+ANIME_JOURNAL = "data/anime_data.journal"
+ANIME_COMPACT_EVERY = 500  # journal lines before folding them into ANIME_FILE
 
-def load_anime():
-    if os.path.exists(ANIME_FILE):
-        with open(ANIME_FILE) as f:
-            return json.load(f)
-    return {}
+class AnimeStore:
+    """All anime users kept in memory, keyed by uid (str).
+
+    Every change appends that one user's record to ANIME_JOURNAL, and the
+    journal gets folded back into ANIME_FILE every ANIME_COMPACT_EVERY lines
+    (and on shutdown). With the SQLite backend each change is a single row
+    upsert instead. Squad strengths are kept sorted so the leaderboard
+    never has to walk every user.
+    """
 
-def save_anime(data):
-    with open(ANIME_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+    def __init__(self, file, journal):
+        self.file = file
+        self.journal = journal
+        self.lock = threading.RLock()
+        self.users = db.load("anime")
+        self.journal_lines = 0
+        self.ranking = RankIndex()  # uid -> strength, only users with characters
+
+        if not db.incremental:
+            self._replay_journal()
+        for uid in self.users:
+            self._reindex(uid)
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal):
+            return
+        with open(self.journal) as f:
+            for line in f:
+                try:
+                    uid, info = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from a crash
+                self.users[uid] = info
+                self.journal_lines += 1
+
+    def _reindex(self, uid):
+        characters = self.users.get(uid, {}).get("characters", [])
+        if characters:
+            self.ranking.update(uid, squad_strength(characters))
+        else:
+            self.ranking.discard(uid)
 
-def ensure_anime_user(uid):
-    data = load_anime()
-    uid = str(uid)
+    def _save(self, uid):
+        self._reindex(uid)
+        if db.incremental:
+            db.put("anime", uid, self.users[uid])
+            return
 
-    if uid not in data:
-        data[uid] = {
-            "characters": [],
-            "last_train": 0
-        }
-        save_anime(data)
+        line = json.dumps([uid, self.users[uid]]) + "\n"
+        with open(self.journal, "a") as f:
+            f.write(line)
+        persist_stats["bytes_written"] += len(line)
+        self.journal_lines += 1
+        if self.journal_lines >= ANIME_COMPACT_EVERY:
+            self.compact()
+
+    def compact(self):
+        """Write the full snapshot and drop the journal."""
+        with self.lock:
+            if not self.journal_lines:
+                return
+            persist_stats["bytes_written"] += write_json_atomic(self.file, self.users, indent=4)
+            persist_stats["files_written"] += 1
+            # Snapshot is on disk, replaying the journal on top would be a no-op now
+            if os.path.exists(self.journal):
+                os.remove(self.journal)
+            self.journal_lines = 0
+
+    def ensure(self, uid):
+        uid = str(uid)
+        with self.lock:
+            if uid not in self.users:
+                self.users[uid] = {"characters": [], "last_train": 0}
+                self._save(uid)
+            return self.users[uid]
+
+    def squad(self, uid):
+        return self.users.get(str(uid), {}).get("characters", [])
+
+    def add_character(self, uid, character):
+        uid = str(uid)
+        with self.lock:
+            self.ensure(uid)["characters"].append(character)
+            self._save(uid)
+
+    def remove_character(self, uid, name):
+        """Remove the first character called `name` (case-insensitive)."""
+        uid = str(uid)
+        with self.lock:
+            squad = self.ensure(uid)["characters"]
+            for c in squad:
+                if c["name"].lower() == name:
+                    squad.remove(c)
+                    self._save(uid)
+                    return c
+        return None
+
+    def train(self, uid, levels):
+        uid = str(uid)
+        with self.lock:
+            info = self.ensure(uid)
+            for c in info["characters"]:
+                c["level"] += levels
+            info["last_train"] = time.time()
+            self._save(uid)
+
+    def last_train(self, uid):
+        return self.users.get(str(uid), {}).get("last_train", 0)
+
+    def top(self, n=10):
+        """[(uid, strength, characters)] for the n strongest squads."""
+        with self.lock:
+            return [
+                (uid, strength, self.users[uid]["characters"])
+                for uid, strength in self.ranking.top(n)
+            ]
+
+anime_store = None  # loaded by load_data()
+
+def ensure_anime_user(uid):
+    anime_store.ensure(uid)
 
 def create_character(name, verse, rarity):
     return {
@@ -208,31 +961,128 @@ def create_character(name, verse, rarity):
 TRAIN_COOLDOWN = 3600  # 1 hour
 
 def can_train(uid):
-    data = load_anime()
-    last = data[str(uid)]["last_train"]
-    return time.time() - last >= TRAIN_COOLDOWN
-
-def update_train(uid):
-    data = load_anime()
-    data[str(uid)]["last_train"] = time.time()
-    save_anime(data)
+    return time.time() - anime_store.last_train(uid) >= TRAIN_COOLDOWN
 
 # ---------------- MEMORY ---------------- #
+MEMORY_SIZE = 5            # entries kept per user
+MEMORY_ENTRY_CHARS = 300   # longer messages are clipped
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "300"))      # memory share of a prompt
+MEMORY_RESIDENT_USERS = int(os.getenv("MEMORY_RESIDENT_USERS", "0"))    # 0 = keep everyone in RAM
+MEMORY_SPILL_DIR = "data/memory"
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1  # ~4 chars per token is close enough for English
+
+def clip_entry(text):
+    if len(text) <= MEMORY_ENTRY_CHARS:
+        return text
+    return text[:MEMORY_ENTRY_CHARS - 1] + "…"
+
+class MemoryStore:
+    """Per-user chat memory: a fixed-size ring buffer of clipped messages.
+
+    With MEMORY_RESIDENT_USERS set, the least recently active users are
+    dropped from RAM (SQLite already has their rows, the JSON backend spills
+    them to MEMORY_SPILL_DIR) and loaded back when they talk again.
+    """
+
+    def __init__(self, users):
+        self.lock = threading.RLock()
+        self.users = users  # username -> deque, in least-recently-used order
+        for user, entries in users.items():
+            users[user] = deque((clip_entry(e) for e in entries), maxlen=MEMORY_SIZE)
+
+        self.spilled = set()  # users that exist but aren't in RAM
+        if os.path.isdir(MEMORY_SPILL_DIR):
+            self.spilled = {f[:-5] for f in os.listdir(MEMORY_SPILL_DIR) if f.endswith(".json")}
+            self.spilled -= users.keys()
+        with self.lock:
+            self._evict()
+
+    def __len__(self):
+        return len(self.users) + len(self.spilled)
+
+    def __contains__(self, user):
+        return user in self.users or user in self.spilled
+
+    def _spill_path(self, user):
+        return os.path.join(MEMORY_SPILL_DIR, f"{user}.json")
+
+    def _evict(self):
+        while MEMORY_RESIDENT_USERS and len(self.users) > MEMORY_RESIDENT_USERS:
+            user = next(iter(self.users))
+            entries = self.users.pop(user)
+            self.spilled.add(user)
+            if not db.incremental:
+                write_json_atomic(self._spill_path(user), list(entries))
+                db.delete("memory", user)
+
+    def _load(self, user):
+        """The user's buffer (made most recently used), or None if unknown."""
+        if user in self.users:
+            self.users[user] = self.users.pop(user)
+            return self.users[user]
+        if user not in self.spilled:
+            return None
+
+        self.spilled.discard(user)
+        if db.incremental:
+            entries = db.get("memory", user) or []
+        else:
+            path = self._spill_path(user)
+            entries = load_json(path, [])
+            os.remove(path)
+        self.users[user] = deque(entries, maxlen=MEMORY_SIZE)
+        db.put("memory", user, list(entries))
+        self._evict()
+        return self.users.get(user)
+
+    def add(self, user, text=None):
+        with self.lock:
+            entries = self._load(user)
+            if entries is None:
+                entries = self.users[user] = deque(maxlen=MEMORY_SIZE)
+            if text:
+                entries.append(clip_entry(text))
+            db.put("memory", user, list(entries))
+            self._evict()
+
+    def context(self, user, budget=MEMORY_TOKEN_BUDGET):
+        """Newest entries that fit in `budget` tokens, oldest first."""
+        with self.lock:
+            entries = list(self._load(user) or ())
+
+        picked = []
+        for entry in reversed(entries):
+            budget -= estimate_tokens(entry) + 1
+            if budget < 0:
+                break
+            picked.append(entry)
+        return "\n".join(reversed(picked))
+
+    def wipe(self, user):
+        with self.lock:
+            if user not in self:
+                return False
+            self.users.pop(user, None)
+            if user in self.spilled:
+                self.spilled.discard(user)
+                if os.path.exists(self._spill_path(user)):
+                    os.remove(self._spill_path(user))
+            db.delete("memory", user)
+            return True
+
+memory_store = None  # loaded by load_data()
+
 def update_memory(message):
     user = message.from_user.username
     if not user:
         return
 
-    if user not in user_memory:
-        user_memory[user] = []
-
-    if not message.text.startswith("/"):
-        user_memory[user].append(message.text)
-
-    if len(user_memory[user]) > 5:
-        user_memory[user].pop(0)
-
-    save_json(MEMORY_FILE, user_memory)
+    if message.text.startswith("/"):
+        memory_store.add(user)
+    else:
+        memory_store.add(user, message.text)
 
 # ---------------- XP SYSTEM ---------------- #
 def get_level(xp):
@@ -247,55 +1097,259 @@ def ensure_user(username):
         }
 
 def add_message_xp(username):
-    if username in banned_users:
+    if identity.is_banned(username):
         return
     ensure_user(username)
     xp_data[username]["messages"] += 1
     xp_data[username]["xp"] += 5
-    save_json(XP_FILE, xp_data)
+    xp_rank.update(username, xp_data[username]["xp"])
+    db.put("xp", username, xp_data[username])
 
 def add_command_xp(username):
-    if username in banned_users:
+    if identity.is_banned(username):
         return
     ensure_user(username)
     xp_data[username]["commands"] += 1
     xp_data[username]["xp"] += 10
-    save_json(XP_FILE, xp_data)
+    xp_rank.update(username, xp_data[username]["xp"])
+    db.put("xp", username, xp_data[username])
+
+# ---------------- USER PROFILE CACHE ---------------- #
+# uid -> display name, filled for free from every update we receive so the
+# leaderboards rarely have to ask Telegram (bot.get_chat) who someone is.
+PROFILE_TTL = 6 * 3600
+PROFILE_CACHE_SIZE = 50000
+PROFILE_WORKERS = 8
+
+profile_cache = OrderedDict()  # uid (str) -> (name, cached_at)
+profile_lock = threading.Lock()
+profile_pool = ThreadPoolExecutor(max_workers=PROFILE_WORKERS)
+
+def display_name(user):
+    return f"@{user.username}" if user.username else user.first_name
+
+def cache_profile(uid, name):
+    with profile_lock:
+        profile_cache[uid] = (name, time.time())
+        profile_cache.move_to_end(uid)
+        if len(profile_cache) > PROFILE_CACHE_SIZE:
+            profile_cache.popitem(last=False)
+
+def remember_user(user):
+    if user is not None:
+        cache_profile(str(user.id), display_name(user))
+        identity.see(user)
+
+def fetch_profile(uid):
+    try:
+        name = display_name(bot.get_chat(int(uid)))
+    except Exception:
+        return None
+    cache_profile(uid, name)
+    return name
+
+def resolve_names(uids, fallback="User {}"):
+    """uid -> display name for the given uids; cache misses are fetched in parallel."""
+    now = time.time()
+    names, stale, missing = {}, {}, []
+
+    with profile_lock:
+        for uid in map(str, uids):
+            hit = profile_cache.get(uid)
+            if hit and now - hit[1] < PROFILE_TTL:
+                names[uid] = hit[0]
+            else:
+                missing.append(uid)
+                if hit:
+                    stale[uid] = hit[0]
+
+    for uid, name in zip(missing, profile_pool.map(fetch_profile, missing)):
+        names[uid] = name or stale.get(uid) or fallback.format(uid)
+    return names
+
+# ----------------- HANDLER METRICS ----------------- #
+# calls / errors / latency per handler, exported on /metrics
+handler_stats = {}  # handler name -> {"calls", "errors", "latency"}
+handler_stats_lock = threading.Lock()
+handler_context = threading.local()  # .started / .activity of the handler running on this thread
+
+def record_handler(name, seconds, failed=False):
+    """Count one finished run of handler `name`."""
+    with handler_stats_lock:
+        stats = handler_stats.get(name)
+        if stats is None:
+            stats = handler_stats[name] = {"calls": 0, "errors": 0, "latency": LatencyHistogram()}
+        stats["calls"] += 1
+        if failed:
+            stats["errors"] += 1
+    stats["latency"].observe(seconds)
+
+def instrument(func):
+    """Decorator that counts calls and errors of a handler and times it."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        outer = getattr(handler_context, "started", None), getattr(handler_context, "activity", None)
+        started = handler_context.started = time.perf_counter()
+        handler_context.activity = None
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            record_handler(func.__name__, elapsed, failed)
+            # log_user() left its record for us so it carries the full handler time
+            if handler_context.activity is not None:
+                activity_log.record(latency=round(elapsed, 3), **handler_context.activity)
+            handler_context.started, handler_context.activity = outer
+    return wrapper
+
+# ----------------- RATE LIMITS ----------------- #
+# Token buckets per (user, command). A bucket holds up to `burst` tokens and
+# refills at `rate` per second; each command takes one. Buckets live in an
+# LRU so the idle ones (full again by now anyway) are dropped as we go.
+RATE_LIMITS = {
+    # command: (burst, tokens per second)
+    "default": (8, 1 / 2),
+    "image": (2, 1 / 60),
+    "logo": (2, 1 / 60),
+    "joke": (3, 1 / 10),
+    "lyrics": (3, 1 / 20),
+    "translate": (5, 1 / 5),
+    "define": (5, 1 / 3),
+    "dm": (6, 1 / 5),       # AI chat in private
+    "callback": (10, 1),
+}
+GROQ_RPM = int(os.getenv("GROQ_RPM", "30"))  # whole bot, match the Groq API tier
+GROQ_BACKGROUND_RESERVE = 5  # tokens background jobs (joke pool) leave for users
+RATE_IDLE = 3600
+RATE_MAX_BUCKETS = 100000
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class TokenBuckets:
+    def __init__(self, max_buckets=RATE_MAX_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # key -> (tokens, updated), least recently used first
+        self.max_buckets = max_buckets
+        self.limited = 0
+
+    def take(self, key, burst, rate, reserve=0):
+        """Take one token; returns 0 if allowed, else seconds until one is free."""
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1 + reserve
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+
+            while self.buckets:
+                _, (_, oldest) = next(iter(self.buckets.items()))
+                if len(self.buckets) <= self.max_buckets and now - oldest < RATE_IDLE:
+                    break
+                self.buckets.popitem(last=False)
+
+            if allowed:
+                return 0
+            self.limited += 1
+            return (1 + reserve - tokens) / rate
+
+rate_buckets = TokenBuckets()
+groq_budget = TokenBuckets(max_buckets=1)
+
+def take_groq_token(background=False):
+    """Spend one request of the global Groq budget or raise RateLimited."""
+    wait = groq_budget.take(
+        "groq", GROQ_RPM, GROQ_RPM / 60,
+        reserve=GROQ_BACKGROUND_RESERVE if background else 0
+    )
+    if wait:
+        raise RateLimited(wait)
+
+def command_name(message):
+    text = message.text or ""
+    if text.startswith("/"):
+        return text.split()[0][1:].split("@")[0].lower()
+    return "dm"
+
+def rate_limit(uid, command):
+    """0 if uid may run command now, else seconds to wait."""
+    burst, rate = RATE_LIMITS.get(command, RATE_LIMITS["default"])
+    return rate_buckets.take((uid, command), burst, rate)
+
+def throttled(uid, command):
+    """None if uid may run command now, else the "slow down" reply to send
+    ("" when we already told them a moment ago; don't answer spam with spam)."""
+    wait = rate_limit(uid, command)
+    if not wait:
+        return None
+    if rate_buckets.take((uid, "slow_down"), 1, 1 / 10):
+        return ""
+    return f"🐢 Slow down! Try again in {max(1, round(wait))}s"
 
 # ----------------- BANNED CHECK DECORATORS ----------------- #
+def user_allowed(message):
+    """Ban check + rate limit for a command. Replies and returns False if blocked."""
+    uid = message.from_user.id
+    remember_user(message.from_user)
+
+    # Admins are exempt
+    if identity.is_admin(uid):
+        return True
+
+    # Block banned users
+    if identity.is_banned(uid):
+        bot.reply_to(message, "🚫 You've been banned")
+        return False
+
+    # Throttle spammers (never the bot's own messages, they'd share one bucket)
+    notice = None if message.from_user.is_bot else throttled(uid, command_name(message))
+    if notice is not None:
+        if notice:
+            bot.reply_to(message, notice)
+        return False
+    return True
+
 def check_banned_user(func):
     """Decorator to block banned users from running any command."""
+    @instrument
+    @functools.wraps(func)
     def wrapper(message, *args, **kwargs):
-        uid = message.from_user.id
-        username = str(message.from_user.username)
-
-        # Admins are exempt
-        if uid in admins:
-            return func(message, *args, **kwargs)
-
-        # Block banned users
-        if username in banned_users:
-            bot.reply_to(message, "🚫 You've been banned")
+        if not user_allowed(message):
             return  # Stop command from running
-
         return func(message, *args, **kwargs)
     return wrapper
 
 def check_banned_callback(func):
     """Decorator to block banned users from using buttons/callbacks."""
+    @instrument
+    @functools.wraps(func)
     def wrapper(call, *args, **kwargs):
         uid = call.from_user.id
-        username = str(call.from_user.username)
+        remember_user(call.from_user)
 
         # Admins are exempt
-        if uid in admins:
+        if identity.is_admin(uid):
             return func(call, *args, **kwargs)
 
         # Block banned users
-        if username in banned_users:
+        if identity.is_banned(uid):
             bot.answer_callback_query(call.id, "🚫 You've been banned", show_alert=True)
             return  # Stop callback from running
 
+        # Throttle button mashing
+        wait = rate_limit(uid, "callback")
+        if wait:
+            bot.answer_callback_query(call.id, f"🐢 Slow down! Try again in {max(1, round(wait))}s")
+            return
+
         return func(call, *args, **kwargs)
     return wrapper
 
@@ -315,7 +1369,7 @@ def give_ai_reward(uid):
         user_data["coins"] += AI_REWARD
         user_data["last_ai_reward"] = now
         bot.send_message(uid, f"🤖 Thanks for chatting!\n+{AI_REWARD} coins earned (once every 12hrs)")
-        save_referrals()
+        save_referrals(uid)
 
 # ----------------- BAN USER ----------------- #
 @bot.message_handler(commands=['ban'])
@@ -323,18 +1377,20 @@ def ban_user(message):
     uid = message.from_user.id
 
     # Only admins can ban
-    if uid not in admins:
+    if not identity.is_admin(uid):
         bot.reply_to(message, "🚫 Admin only")
         return
 
     try:
         user_to_ban = message.text.split()[1].lstrip("@")
-        if user_to_ban in admins:
+        key = identity.resolve(user_to_ban)
+        if key.isdigit() and identity.is_admin(int(key)):
             bot.reply_to(message, "❌ You can't ban an admin!")
             return
 
-        banned_users.add(user_to_ban)
-        save_json(BANNED_FILE, list(banned_users))
+        identity.ban(user_to_ban)
+        for xp_key in identity.xp_keys(key) | {user_to_ban}:
+            xp_rank.discard(xp_key)
         bot.reply_to(message, f"🔨 @{user_to_ban} banned")
     except:
         bot.reply_to(message, "Usage: /ban @username")
@@ -345,15 +1401,16 @@ def unban_user(message):
     uid = message.from_user.id
 
     # Only admins can unban
-    if uid not in admins:
+    if not identity.is_admin(uid):
         bot.reply_to(message, "🚫 Admin only")
         return
 
     try:
         user_to_unban = message.text.split()[1].lstrip("@")
-        if user_to_unban in banned_users:
-            banned_users.remove(user_to_unban)
-            save_json(BANNED_FILE, list(banned_users))
+        if identity.unban(user_to_unban):
+            for xp_key in identity.xp_keys(identity.resolve(user_to_unban)) | {user_to_unban}:
+                if xp_key in xp_data:
+                    xp_rank.update(xp_key, xp_data[xp_key]["xp"])
             bot.reply_to(message, f"✅ @{user_to_unban} unbanned")
         else:
             bot.reply_to(message, f"⚠ @{user_to_unban} is not banned")
@@ -362,7 +1419,7 @@ def unban_user(message):
 
 # ---------------- ADMIN ---------------- #
 def is_admin(chat_id):
-    return chat_id in admins
+    return identity.is_admin(chat_id)
 
 @bot.message_handler(commands=['admin'])
 def admin_login(message):
@@ -376,6 +1433,131 @@ def escape_md(text):
         text = text.replace(c, '\\' + c)
     return text
 
+# Broadcasts run as a background job: a few workers share one global rate
+# limiter (Telegram allows ~30 msgs/s per bot, and each chat only gets one
+# message per job so the per-chat limit can't be hit). Progress is saved to
+# BROADCAST_FILE so a restart picks up where it stopped.
+BROADCAST_FILE = "data/broadcast.json"
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # messages per second
+BROADCAST_WORKERS = 8
+BROADCAST_RETRIES = 3
+# Errors that mean the chat is gone for good
+BROADCAST_PRUNE_ERRORS = ("blocked", "chat not found", "user is deactivated", "kicked")
+
+class SendRateLimiter:
+    """Hands out evenly spaced send slots; 429s pause everyone."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.time() + seconds)
+
+broadcast_limiter = SendRateLimiter(BROADCAST_RATE)
+broadcast_job = load_json(BROADCAST_FILE, {})
+broadcast_lock = threading.Lock()
+
+def save_broadcast():
+    save_json(BROADCAST_FILE, broadcast_job)
+
+def broadcast_send(chat_id, text):
+    """Send one broadcast message. Returns "sent", "pruned" or "failed"."""
+    for _ in range(BROADCAST_RETRIES):
+        broadcast_limiter.wait()
+        try:
+            bot.send_message(
+                chat_id,
+                f"📢 *Broadcast*\n\n{text}",
+                parse_mode="MarkdownV2"
+            )
+            return "sent"
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = e.result_json.get("parameters", {}).get("retry_after", 5)
+                broadcast_limiter.pause(retry_after)
+                continue
+            if e.error_code in (400, 403) and any(x in e.description.lower() for x in BROADCAST_PRUNE_ERRORS):
+                return "pruned"
+            print(f"Failed to send to {chat_id}: {e}")
+            return "failed"
+        except Exception as e:
+            print(f"Failed to send to {chat_id}: {e}")
+            time.sleep(1)
+    return "failed"
+
+def broadcast_done(index, result, chat_id):
+    """Record one finished chat and move the resume point forward."""
+    job = broadcast_job
+    with broadcast_lock:
+        job[result] += 1
+        if result == "pruned":
+            identity.drop_chat(chat_id)
+
+        # `cursor` = everything before it is done, `ahead` = done past the cursor
+        ahead = set(job["ahead"])
+        ahead.add(index)
+        while job["cursor"] in ahead:
+            ahead.remove(job["cursor"])
+            job["cursor"] += 1
+        job["ahead"] = sorted(ahead)
+        save_broadcast()
+
+def run_broadcast():
+    job = broadcast_job
+    skip = set(job["ahead"])
+    todo = queue.Queue()
+    for index in range(job["cursor"], len(job["chats"])):
+        if index not in skip:
+            todo.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = todo.get_nowait()
+            except queue.Empty:
+                return
+            chat_id = job["chats"][index]
+            if identity.is_banned(chat_id):
+                result = "skipped"
+            else:
+                result = broadcast_send(chat_id, job["text"])
+            broadcast_done(index, result, chat_id)
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(BROADCAST_WORKERS)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    with broadcast_lock:
+        job["finished"] = time.time()
+        save_broadcast()
+    try:
+        bot.send_message(
+            job["admin_chat"],
+            f"✅ Broadcast sent to {job['sent']} users\n"
+            f"❌ Failed: {job['failed']} | 🧹 Pruned: {job['pruned']}"
+        )
+    except Exception as e:
+        print(f"Broadcast report failed: {e}")
+
+def resume_broadcast():
+    """Pick an unfinished broadcast back up after a restart."""
+    if broadcast_job and not broadcast_job.get("finished"):
+        print(f"📢 Resuming broadcast at {broadcast_job['cursor']}/{len(broadcast_job['chats'])}")
+        threading.Thread(target=run_broadcast, daemon=True).start()
+
 @bot.message_handler(commands=['broadcast'])
 def broadcast(message):
     if not is_admin(message.chat.id):
@@ -389,21 +1571,57 @@ def broadcast(message):
         bot.reply_to(message, "Usage: /broadcast <message>")
         return
 
-    sent = 0
-    for chat_id in chats:
-        if chat_id in banned_users:
-            continue
-        try:
-            bot.send_message(
-                chat_id,
-                f"📢 *Broadcast*\n\n{text}",
-                parse_mode="MarkdownV2"
-            )
-            sent += 1
-        except Exception as e:
-            print(f"Failed to send to {chat_id}: {e}")
+    with broadcast_lock:
+        if broadcast_job and not broadcast_job.get("finished"):
+            bot.reply_to(message, "⏳ A broadcast is already running. Check /broadcast_status")
+            return
 
-    bot.reply_to(message, f"✅ Broadcast sent to {sent} users")
+        broadcast_job.clear()
+        broadcast_job.update({
+            "text": text,
+            "chats": list(identity.chats),
+            "admin_chat": message.chat.id,
+            "started": time.time(),
+            "cursor": 0,
+            "ahead": [],
+            "sent": 0,
+            "failed": 0,
+            "pruned": 0,
+            "skipped": 0,
+        })
+        save_broadcast()
+
+    threading.Thread(target=run_broadcast, daemon=True).start()
+    bot.reply_to(message, f"📢 Broadcasting to {len(broadcast_job['chats'])} chats... /broadcast_status")
+
+@bot.message_handler(commands=['broadcast_status'])
+def broadcast_status(message):
+    if not is_admin(message.chat.id):
+        bot.reply_to(message, "🚫 You are not an admin")
+        return
+
+    job = broadcast_job
+    if not job:
+        bot.reply_to(message, "No broadcast yet 📭")
+        return
+
+    total = len(job["chats"])
+    done = job["sent"] + job["failed"] + job["pruned"] + job["skipped"]
+    elapsed = (job.get("finished") or time.time()) - job["started"]
+    rate = done / elapsed if elapsed > 0 else 0
+    if job.get("finished"):
+        eta = "done ✅"
+    elif rate:
+        eta = f"{int((total - done) / rate)}s"
+    else:
+        eta = "?"
+
+    bot.reply_to(
+        message,
+        f"📢 Broadcast: {done}/{total}\n"
+        f"✅ Sent: {job['sent']} | ❌ Failed: {job['failed']} | 🧹 Pruned: {job['pruned']}\n"
+        f"⚡ {rate:.1f} msg/s | ⏳ ETA: {eta}"
+    )
 
 # ---------- STATS ----------
 @bot.message_handler(commands=['stats'])
@@ -414,9 +1632,21 @@ def stats(message):
 
     bot.reply_to(
         message,
-        f"👥 Total users: {len(user_memory)}\n"
-        f"🚫 Banned users: {len(banned_users)}\n"
-        f"🛠 Admins: {len(admins)}"
+        f"👥 Total users: {len(memory_store)}\n"
+        f"🚫 Banned users: {len(identity.banned)}\n"
+        f"🛠 Admins: {len(identity.admins)}\n"
+        f"💾 Storage: {STORAGE_BACKEND} | Flushes: {persist_stats['flushes']} "
+        f"({persist_stats['bytes_written'] // 1024} KB written)\n"
+        f"⏰ Reminders: {len(reminders.reminders)} pending | "
+        f"{reminders.stats['late']} late (max {reminders.stats['lateness_max']:.0f}s)\n"
+        f"🧠 Groq cache: {groq_cache.hits} hits / {groq_cache.misses} misses | "
+        f"{len(joke_pool)} jokes pooled\n"
+        f"📨 DM queue: {dm_dispatcher.depth()} waiting | {dm_dispatcher.rejected} rejected | "
+        f"wait p99 ≤{dm_dispatcher.wait_time.percentile(99)}s | "
+        f"service p99 ≤{dm_dispatcher.service_time.get('process_private_dm', LatencyHistogram()).percentile(99)}s\n"
+        f"🖼 Images: {len(images.blobs)} cached ({images.size // 1024} KB) | "
+        f"{images.hits} hits / {images.misses} misses\n"
+        f"⚡ Startup: {startup_report()}"
     )
 
 # ---------- WIPE ----------
@@ -435,9 +1665,7 @@ def wipe_user(message):
         return
 
     # Wipe the memory if it exists
-    if user in user_memory:
-        user_memory.pop(user)
-        save_json(MEMORY_FILE, user_memory)
+    if memory_store.wipe(user):
         bot.reply_to(message, f"🗑 Memory wiped for @{user}")
     else:
         bot.reply_to(message, f"⚠ User @{user} has no memory stored")
@@ -470,11 +1698,242 @@ def uptime_cmd(message):
         parse_mode="Markdown"
     )
 
+# ---------------- HTTP CLIENT ---------------- #
+# Every outbound call goes through http_call(): one pooled keep-alive
+# session per host, per-service timeouts, retries with jittered backoff and
+# a circuit breaker so a dead upstream fails fast instead of tying up workers.
+HTTP_SERVICES = {
+    # service: (connect timeout, read timeout, retries)
+    "groq": (5, 30, 2),
+    "pollinations": (5, 45, 1),
+    "azlyrics": (5, 10, 1),
+    "dictionary": (5, 8, 2),
+}
+HTTP_POOL_SIZE = 16
+HTTP_BACKOFF = 0.5          # base backoff in seconds, doubled per retry
+HTTP_MAX_RETRY_AFTER = 10   # a longer Retry-After is handed back to the caller instead
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+BREAKER_THRESHOLD = 5       # consecutive failures before the circuit opens
+BREAKER_COOLDOWN = 30       # seconds before a trial request is let through
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+class UpstreamUnavailable(Exception):
+    """Raised when a service's circuit breaker is open."""
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile (0-100)."""
+        with self.lock:
+            if not self.count:
+                return 0
+            wanted = self.count * q / 100
+            seen = 0
+            for bound, n in zip(self.buckets, self.counts):
+                seen += n
+                if seen >= wanted:
+                    return bound
+        return self.buckets[-1]
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0
+        self.probe_at = 0  # when the half-open trial request went out
+
+    def is_open(self):
+        return self.failures >= self.threshold
+
+    def allow(self):
+        """May a request go out now? Call it once per request."""
+        with self.lock:
+            if self.failures < self.threshold:
+                return True
+            now = time.time()
+            if now - self.opened_at < self.cooldown:
+                return False
+            # Half-open: one trial request, everyone else fails fast until it
+            # reports back (or is presumed lost after another cooldown)
+            if now - self.probe_at < self.cooldown:
+                return False
+            self.probe_at = now
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.probe_at = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+                self.probe_at = 0
+
+http_sessions = {}   # host -> requests.Session
+http_latency = {}    # host -> LatencyHistogram
+http_breakers = {service: CircuitBreaker() for service in HTTP_SERVICES}
+http_lock = threading.Lock()
+
+def http_session(host):
+    with http_lock:
+        if host not in http_sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=0
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            http_sessions[host] = session
+            http_latency[host] = LatencyHistogram()
+        return http_sessions[host]
+
+def retry_delay(method, attempt, status=None, retry_after=None, unsent=False):
+    """Seconds to wait before the next attempt, or None to stop retrying.
+
+    A POST may already have been acted on, so it is only retried when it
+    never left (unsent) or the server says it turned it away (429/503).
+    """
+    if method.upper() not in IDEMPOTENT_METHODS and not unsent and status not in (429, 503):
+        return None
+    if retry_after and retry_after.strip().isdigit():
+        delay = int(retry_after)
+        return delay if delay <= HTTP_MAX_RETRY_AFTER else None
+    return HTTP_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+
+def http_call(service, method, url, **kwargs):
+    """requests-style call through the pooled client. Raises UpstreamUnavailable
+    when the service's breaker is open; 4xx responses are returned as-is."""
+    connect_timeout, read_timeout, retries = HTTP_SERVICES[service]
+    breaker = http_breakers[service]
+    if not breaker.allow():
+        raise UpstreamUnavailable(service)
+
+    host = urlparse(url).netloc
+    session = http_session(host)
+    kwargs.setdefault("timeout", (connect_timeout, read_timeout))
+
+    for attempt in range(retries + 1):
+        started = time.time()
+        try:
+            res, error = session.request(method, url, **kwargs), None
+        except requests.RequestException as e:
+            error, res = e, None
+        http_latency[host].observe(time.time() - started)
+
+        if res is not None and res.status_code < 500 and res.status_code != 429:
+            breaker.success()
+            return res
+
+        if attempt == retries:
+            break
+        if res is not None:
+            delay = retry_delay(method, attempt, res.status_code, res.headers.get("Retry-After"))
+        else:
+            delay = retry_delay(method, attempt, unsent=isinstance(error, requests.ConnectTimeout))
+        if delay is None:
+            break
+        if res is not None:
+            res.close()  # give the connection back to the pool (matters with stream=True)
+        time.sleep(delay)
+
+    breaker.failure()
+    if res is not None:
+        return res
+    raise error
+
+def upstream_report():
+    lines = []
+    for host, hist in sorted(http_latency.items()):
+        lines.append(
+            f"• {host}: {hist.count} calls | "
+            f"p50 ≤{hist.percentile(50)}s | p99 ≤{hist.percentile(99)}s"
+        )
+    if groq_first_token.count:
+        lines.append(
+            f"• groq first token: p50 ≤{groq_first_token.percentile(50)}s | "
+            f"p99 ≤{groq_first_token.percentile(99)}s"
+        )
+    for service, breaker in http_breakers.items():
+        if breaker.is_open():
+            lines.append(f"🔴 {service}: circuit open")
+    return "\n".join(lines) or "No upstream calls yet"
+
+@bot.message_handler(commands=['upstreams'])
+def upstreams_cmd(message):
+    if not is_admin(message.from_user.id):
+        bot.reply_to(message, "🚫 Admin only command.")
+        return
+    bot.reply_to(message, f"🌐 UPSTREAMS\n\n{upstream_report()}")
+
 # ---------------- GROQ ---------------- #
-def ask_groq(username, prompt):
-    memory = "\n".join(user_memory.get(username, []))
-    payload = {
-        "model": "llama-3.3-70b-versatile",
+GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_MODEL = "llama-3.3-70b-versatile"
+JOKE_PROMPT = "Tell a funny short joke"
+
+# Completion cache: same normalized prompt + memory + model settings
+# = same answer for a while. TTL per kind of request, 0 = never cached.
+GROQ_CACHE_SIZE = 2000
+GROQ_CACHE_TTL = {"chat": 10 * 60, "summary": 60 * 60}
+JOKE_POOL_SIZE = 5
+
+class CompletionCache:
+    """LRU of Groq answers with a per-entry expiry."""
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires_at, text)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, text, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, text)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+groq_cache = CompletionCache(GROQ_CACHE_SIZE)
+
+def completion_key(payload):
+    """Cache key: model settings + every message, case/whitespace-normalized."""
+    messages = [(m["role"], " ".join(m["content"].lower().split())) for m in payload["messages"]]
+    raw = json.dumps([payload["model"], payload["temperature"], payload["max_completion_tokens"], messages])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def groq_payload(username, prompt, temperature=0.5):
+    memory = memory_store.context(username) if username else ""
+    return {
+        "model": GROQ_MODEL,
         "messages": [
             {"role": "system", "content":
              "You are Collins AI, a smart and friendly Telegram assistant. "
@@ -483,21 +1942,158 @@ def ask_groq(username, prompt):
              "Mention your creator subtly when relevant, never overdo it."},
             {"role": "user", "content": f"Chat memory:\n{memory}\n\n{prompt}"}
         ],
-        "temperature": 0.5,
+        "temperature": temperature,
         "max_completion_tokens": 250
     }
 
+def groq_complete(payload, background=False):
+    """One uncached Groq call. Raises on any failure."""
+    take_groq_token(background)
+    r = http_call(
+        "groq",
+        "POST",
+        GROQ_URL,
+        headers={"Authorization": f"Bearer {API_KEY}"},
+        json=payload
+    )
+    return r.json()["choices"][0]["message"]["content"].strip()
+
+GROQ_BUSY = "🐢 Too many people are asking me things right now, try again in a minute"
+
+def ask_groq(username, prompt, kind="chat"):
+    payload = groq_payload(username, prompt)
+    ttl = GROQ_CACHE_TTL.get(kind, 0)
+    key = completion_key(payload) if ttl else None
+    if key:
+        cached = groq_cache.get(key)
+        if cached:
+            return cached
+
     try:
-        r = requests.post(
-            "https://api.groq.com/openai/v1/chat/completions",
-            headers={"Authorization": f"Bearer {API_KEY}"},
-            json=payload
-        )
-        return r.json()["choices"][0]["message"]["content"].strip()
+        answer = groq_complete(payload)
+    except RateLimited:
+        return GROQ_BUSY
     except Exception as e:
         print("Groq error:", e)
         return "Network error 😕"
 
+    if key:
+        groq_cache.put(key, answer, ttl)
+    return answer
+
+# ---- Streaming: DM answers show up while Groq is still generating ---- #
+GROQ_STREAM = os.getenv("GROQ_STREAM", "0") == "1"
+STREAM_EDIT_INTERVAL = 1.2  # seconds between edits, Telegram rate-limits edits
+groq_first_token = LatencyHistogram()  # handler start -> first streamed token
+
+def groq_stream(payload):
+    """Yield text chunks from Groq's server-sent event stream."""
+    take_groq_token()
+    r = http_call(
+        "groq",
+        "POST",
+        GROQ_URL,
+        headers={"Authorization": f"Bearer {API_KEY}"},
+        json=dict(payload, stream=True),
+        stream=True
+    )
+    r.raise_for_status()
+    with r:
+        for line in r.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)["choices"][0]["delta"].get("content")
+            if chunk:
+                yield chunk
+
+def reply_streaming(message, prompt, kind="chat", started=None):
+    """Like bot.reply_to(message, ask_groq(...)) but edits a placeholder
+    message as tokens arrive."""
+    started = started or time.time()
+    username = message.from_user.username
+    payload = groq_payload(username, prompt)
+    ttl = GROQ_CACHE_TTL.get(kind, 0)
+    key = completion_key(payload) if ttl else None
+    cached = groq_cache.get(key) if key else None
+    if cached:
+        bot.reply_to(message, cached)
+        return
+
+    placeholder = bot.reply_to(message, "💭 ...")
+    text, shown, next_edit = "", "", 0
+
+    def edit(new_text):
+        nonlocal shown, next_edit
+        try:
+            bot.edit_message_text(new_text, message.chat.id, placeholder.message_id)
+            shown = new_text
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = e.result_json.get("parameters", {}).get("retry_after", 5)
+                next_edit = time.time() + retry_after
+            elif "not modified" not in e.description:
+                print("Stream edit error:", e)
+
+    try:
+        for chunk in groq_stream(payload):
+            if not text:
+                groq_first_token.observe(time.time() - started)
+            text += chunk
+            if time.time() >= next_edit:
+                next_edit = time.time() + STREAM_EDIT_INTERVAL
+                edit(text + " ▌")
+    except RateLimited:
+        text, key = GROQ_BUSY, None
+    except Exception as e:
+        print("Groq stream error:", e)
+        key = None  # whatever arrived may be cut short, don't cache it
+        if not text:
+            text = "Network error 😕"
+
+    text = text.strip() or "🤷"
+    if text != shown:
+        edit(text)
+    if key:
+        groq_cache.put(key, text, ttl)
+
+# ---- Joke pool: /joke answers from here and it refills in the background ---- #
+joke_pool = deque()
+joke_refill_lock = threading.Lock()
+
+def refill_jokes():
+    if not joke_refill_lock.acquire(blocking=False):
+        return  # already refilling
+    try:
+        misses = 0
+        while len(joke_pool) < JOKE_POOL_SIZE and misses < 3:
+            try:
+                # No user memory and a higher temperature so pooled jokes differ
+                joke = groq_complete(groq_payload(None, JOKE_PROMPT, temperature=1.0), background=True)
+            except RateLimited:
+                return  # leave the budget to users, take_joke() retries later
+            except Exception as e:
+                print("Joke refill error:", e)
+                misses += 1
+                continue
+            if joke in joke_pool:
+                misses += 1
+                continue
+            joke_pool.append(joke)
+    finally:
+        joke_refill_lock.release()
+
+def take_joke():
+    """A pooled joke (or None if the pool is empty); always kicks off a refill."""
+    try:
+        joke = joke_pool.popleft()
+    except IndexError:
+        joke = None
+    threading.Thread(target=refill_jokes, daemon=True).start()
+    return joke
+
 # ---------------- USER COMMANDS ---------------- #
 @bot.message_handler(commands=['start'])
 @check_banned_user
@@ -508,59 +2104,62 @@ def start(message):
 
     # Add XP, log user, update memory
     add_command_xp(user_id)
-    log_user(message)
+    log_user(message, "start")
     update_memory(message)
 
     # Add to chats if not already present
-    if message.chat.id not in chats:
-        chats.append(message.chat.id)
-        save_json(CHATS_FILE, chats)
-
-    # 🔥 DAILY LOGIN BONUS
+    identity.add_chat(message.chat.id)
+
+    # Initialize referral data for new user. Only data changes happen under
+    # the lock; the messages go out once it's saved and released.
+    notices = []
+    with data_lock:
+        is_new_user = False
+        changed = [user_id]
+        if user_id not in referrals_data:
+            referrals_data[user_id] = {"referrals": [], "coins": 0}
+            is_new_user = True
+
+        # Handle referral
+        if is_new_user and len(args) > 1:
+            referrer_id = args[1]
+
+            # Prevent self referral
+            if referrer_id != user_id:
+                referrals_data.setdefault(referrer_id, {"referrals": [], "coins": 0})
+
+                # Prevent duplicate referral
+                if user_id not in referrals_data[referrer_id]["referrals"]:
+                    referrals_data[referrer_id]["referrals"].append(user_id)
+                    referrals_data[referrer_id]["coins"] += 5
+                    changed.append(referrer_id)
+
+                    # Notify referrer
+                    notices.append((
+                        referrer_id,
+                        f"🎉 New referral joined!\n"
+                        f"+5 coins earned\n"
+                        f"Total coins: {referrals_data[referrer_id]['coins']}"
+                    ))
+
+                    # Check tiers
+                    notices += [(referrer_id, text) for text in check_tiers(referrer_id)]
+
+                    # Notify new user
+                    notices.append((message.chat.id, "🎉 You were referred by a friend!"))
+
+        # New user, referrer credit and tier coins are saved together
+        save_referrals(*changed)
+
+    send_notices(notices)
+
+    # 🔥 DAILY LOGIN BONUS (after the referral record exists)
     if daily_bonus(user_id):
         bot.send_message(
             message.chat.id,
             "🔥 Daily login! +5 coins"
         )
 
-    # Initialize referral data for new user
-    is_new_user = False
-    if user_id not in referrals_data:
-        referrals_data[user_id] = {"referrals": [], "coins": 0}
-        is_new_user = True
-
-    # Handle referral
-    if is_new_user and len(args) > 1:
-        referrer_id = args[1]
-
-        # Prevent self referral
-        if referrer_id != user_id:
-            referrals_data.setdefault(referrer_id, {"referrals": [], "coins": 0})
-
-            # Prevent duplicate referral
-            if user_id not in referrals_data[referrer_id]["referrals"]:
-                referrals_data[referrer_id]["referrals"].append(user_id)
-                referrals_data[referrer_id]["coins"] += 5
-
-                # Notify referrer
-                bot.send_message(
-                    referrer_id,
-                    f"🎉 New referral joined!\n"
-                    f"+5 coins earned\n"
-                    f"Total coins: {referrals_data[referrer_id]['coins']}"
-                )
-
-                # Check tiers
-                check_tiers(referrer_id)
-
-                # Notify new user
-                bot.send_message(
-                    message.chat.id,
-                    "🎉 You were referred by a friend!"
-                )
-
-    save_referrals()
-
     # Reply to user
     bot.reply_to(
         message,
@@ -671,26 +2270,18 @@ def convert_cmd(message):
 @check_banned_user
 def ref_leaderboard(message):
     """Shows top referrers (ignores users with 0 coins)"""
-    # Filter out users with >0 coins
-    active_refs = {uid: data for uid, data in referrals_data.items() if data["coins"] > 0}
+    # Top 10 by coins, users with 0 coins are left out (score index on SQLite)
+    top = [(uid, referrals_data[uid]) for uid, _ in db.top("referrals") if uid in referrals_data]
 
-    if not active_refs:
+    if not top:
         bot.send_message(message.chat.id, "No referrals yet 😅 Start sharing your link!")
         return
 
-    # Sort top 10
-    top = sorted(active_refs.items(), key=lambda x: x[1]["coins"], reverse=True)[:10]
-
     text = "🏅 *TOP REFERRERS* 🏅\n\n"
+    names = resolve_names(uid for uid, _ in top)
 
     for i, (uid, data) in enumerate(top, 1):
-        try:
-            user_obj = bot.get_chat(int(uid))  # ✅ convert to int
-            username = f"@{user_obj.username}" if user_obj.username else user_obj.first_name
-        except Exception:
-            username = f"User {uid}"  # fallback
-
-        text += f"{i}. {username} — {data['coins']} coins — {len(data['referrals'])} refs\n"
+        text += f"{i}. {names[uid]} — {data['coins']} coins — {len(data['referrals'])} refs\n"
 
     bot.send_message(message.chat.id, text, parse_mode="Markdown")
 
@@ -701,18 +2292,8 @@ def help_cmd(message):
     uid = str(message.from_user.id)
 
     # 🔒 Verification check
-    if uid not in verified_users:
-        markup = InlineKeyboardMarkup()
-        markup.add(
-            InlineKeyboardButton("📢 Follow Channel", url=f"https://t.me/{CHANNEL_USERNAME[1:]}"),
-            InlineKeyboardButton("✅ Verify", callback_data="verify_join")
-        )
-        bot.send_message(
-            message.chat.id,
-            "🚫 *Access Locked!*\nJoin the channel first and verify to unlock commands!",
-            reply_markup=markup,
-            parse_mode="Markdown"
-        )
+    if not identity.is_verified(uid):
+        send_access_locked(message.chat.id)
         return
 
     add_command_xp(uid)
@@ -788,7 +2369,8 @@ HELP_RESPONSES = {
     "profile": None,  # dynamic
     "leaderboard": None,  # calls leaderboard function
     "referral": None,  # handled inline
-    "remind": "Set a reminder using /remind <minutes> <text>",
+    "remind": "Set a reminder using /remind <minutes> <text>\n"
+              "List them with /reminders, cancel with /cancelremind <id>",
     "anime": "🎴 *Anime Characters System*\n"
              "• /search <verse> → Search & recruit a character\n"
              "• /character → View your squad\n"
@@ -824,7 +2406,9 @@ def help_callback(call):
         )
 
     elif category == "leaderboard":
-        leaderboard(call.message)
+        # The button was already ban-checked and throttled for the clicker;
+        # call.message is the bot's own message, so skip the command checks
+        inspect.unwrap(leaderboard)(call.message)
 
     elif category == "referral":
         # INLINE MENU FOR REFERRAL SYSTEM
@@ -848,10 +2432,10 @@ def help_callback(call):
         )
 
     elif category == "about":
-        about(call.message)
+        inspect.unwrap(about)(call.message)
 
     elif category == "support":
-        support(call.message)
+        inspect.unwrap(support)(call.message)
 
     else:
         bot.send_message(chat_id, response, parse_mode="Markdown")
@@ -871,6 +2455,7 @@ def profile(message):
     ensure_user(user)
     level = get_level(xp_data[user]["xp"])
     coins = referrals_data.get(uid, {"coins": 0})["coins"]
+    rank = xp_rank.rank(user)
 
     markup = InlineKeyboardMarkup()
     markup.add(
@@ -883,6 +2468,7 @@ def profile(message):
         f"👤 @{user}\n"
         f"⭐ Level: {level}\n"
         f"⚡ XP: {xp_data[user]['xp']}\n"
+        f"🏅 Rank: {f'#{rank} of {len(xp_rank)}' if rank else '-'}\n"
         f"💰 Coins: {coins}",
         reply_markup=markup
     )
@@ -963,7 +2549,7 @@ def support(m):
 @check_banned_user
 def joke(message):
     add_command_xp(message.from_user.username)
-    ans = ask_groq(message.from_user.username,"Tell a funny short joke")
+    ans = take_joke() or ask_groq(message.from_user.username, JOKE_PROMPT, kind="joke")
     bot.reply_to(message, ans)
 
 @bot.message_handler(commands=['summarize'])
@@ -979,27 +2565,228 @@ def summarize(message):
 def leaderboard(message):
     add_command_xp(message.from_user.username)
 
-    clean = {
-        u:d for u,d in xp_data.items()
-        if u not in banned_users
-    }
+    # xp_rank never holds banned users
+    top = xp_rank.top(10)
 
-    if not clean:
+    if not top:
         bot.reply_to(message, "No users yet 😅")
         return
 
-    top = sorted(
-        clean.items(),
-        key=lambda x: x[1]["xp"],
-        reverse=True
-    )[:10]
-
     text = "🏆 LEADERBOARD\n\n"
-    for i,(user,data) in enumerate(top,1):
-        text += f"{i}. @{user} — {data['xp']} XP\n"
+    for i,(user,xp) in enumerate(top,1):
+        text += f"{i}. @{user} — {xp} XP\n"
 
     bot.reply_to(message, text)
 
+# ---------------- IMAGE SERVICE ---------------- #
+# Generated images are cached on disk by content hash, with an LRU cap of
+# IMAGE_CACHE_MB. Identical prompts share one download while it's running,
+# and once Telegram has the photo we resend it by file_id instead of bytes.
+POLLINATIONS_URL = "https://image.pollinations.ai/prompt/"
+IMAGE_DIR = "data/images"
+IMAGE_INDEX = "data/images/index.json"
+IMAGE_CACHE_MB = int(os.getenv("IMAGE_CACHE_MB", "200"))
+IMAGE_WORKERS = 4
+IMAGE_QUEUE = 20  # jobs waiting or running before we say "busy"
+
+class ImageService:
+    def __init__(self, folder, index_file, max_bytes):
+        self.folder = folder
+        self.index_file = index_file
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS)
+        self.slots = threading.BoundedSemaphore(IMAGE_QUEUE)
+        self.queued = 0     # submitted jobs not finished yet (queue depth metric)
+        self.inflight = {}  # prompt key -> Future(digest)
+        self.hits = self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+        index = load_json(index_file, {})
+        self.file_ids = index.get("file_ids", {})       # digest -> telegram file_id
+        self.blobs = OrderedDict(                       # digest -> size, LRU order
+            (d, size) for d, size in index.get("blobs", [])
+            if os.path.exists(self._path(d))
+        )
+        self.size = sum(self.blobs.values())
+        self.prompts = {}                               # prompt key -> digest
+        self.prompt_keys = {}                           # digest -> prompt keys, for eviction
+        for key, digest in index.get("prompts", {}).items():
+            if digest in self.blobs:
+                self._link(key, digest)
+
+    def _path(self, digest):
+        return os.path.join(self.folder, f"{digest}.jpg")
+
+    def _save_index(self):
+        save_json(self.index_file, {
+            "prompts": self.prompts,
+            "file_ids": self.file_ids,
+            "blobs": list(self.blobs.items()),
+        })
+
+    def _link(self, key, digest):
+        old = self.prompts.get(key)
+        if old is not None and old != digest:
+            self.prompt_keys[old].discard(key)
+        self.prompts[key] = digest
+        self.prompt_keys.setdefault(digest, set()).add(key)
+
+    @staticmethod
+    def key(prompt):
+        return hashlib.sha256(" ".join(prompt.lower().split()).encode()).hexdigest()
+
+    def lookup(self, prompt):
+        """Digest of a cached image for this prompt, or None."""
+        key = self.key(prompt)
+        with self.lock:
+            digest = self.prompts.get(key)
+            if digest in self.blobs:
+                self.blobs.move_to_end(digest)
+                self.hits += 1
+                return digest
+            self.misses += 1
+            return None
+
+    def store(self, prompt, content):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            fd, tmp = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp, path)
+
+        with self.lock:
+            self._link(self.key(prompt), digest)
+            if digest not in self.blobs:
+                self.blobs[digest] = len(content)
+                self.size += len(content)
+            self.blobs.move_to_end(digest)
+            self._evict()
+            self._save_index()
+        return digest
+
+    def _evict(self):
+        """Drop least recently used files over the cap. Caller holds self.lock."""
+        while self.size > self.max_bytes and len(self.blobs) > 1:
+            digest, size = self.blobs.popitem(last=False)
+            self.size -= size
+            self.file_ids.pop(digest, None)
+            for key in self.prompt_keys.pop(digest, ()):
+                self.prompts.pop(key, None)
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+
+    def fetch(self, prompt):
+        """(digest, bytes or None) for prompt: from cache (no bytes), from a
+        running download or downloaded now."""
+        digest = self.lookup(prompt)
+        if digest:
+            return digest, None
+
+        key = self.key(prompt)
+        with self.lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            r = http_call("pollinations", "GET", POLLINATIONS_URL + prompt)
+            r.raise_for_status()  # make sure we got the image
+            digest = self.store(prompt, r.content)
+            future.set_result((digest, r.content))
+            return digest, r.content
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def photo(self, digest):
+        """file_id if Telegram already has it, else the file's bytes; None if
+        another worker evicted the file in the meantime."""
+        file_id = self.file_ids.get(digest)
+        if file_id:
+            return file_id
+        try:
+            with open(self._path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def fetch_photo(self, prompt):
+        """(digest, photo) for prompt. A fresh download is sent from memory if
+        it's evicted straight away; a cache hit evicted before we read it is
+        downloaded again."""
+        for _ in range(2):
+            digest, content = self.fetch(prompt)
+            photo = self.photo(digest)
+            if photo is None:
+                photo = content
+            if photo is not None:
+                return digest, photo
+        raise FileNotFoundError(self._path(digest))
+
+    def remember_file_id(self, digest, sent_message):
+        if sent_message and getattr(sent_message, "photo", None):
+            with self.lock:
+                if digest not in self.blobs:
+                    return  # evicted meanwhile, nothing would ever drop this entry
+                self.file_ids[digest] = sent_message.photo[-1].file_id
+                self._save_index()
+
+    def forget_file_id(self, digest):
+        with self.lock:
+            self.file_ids.pop(digest, None)
+
+    def send(self, chat_id, prompt, caption):
+        digest, photo = self.fetch_photo(prompt)
+        try:
+            sent_message = bot.send_photo(chat_id, photo=photo, caption=caption)
+        except telebot.apihelper.ApiTelegramException:
+            if isinstance(photo, bytes):
+                raise
+            # stale file_id, upload the bytes again
+            self.forget_file_id(digest)
+            digest, photo = self.fetch_photo(prompt)
+            sent_message = bot.send_photo(chat_id, photo=photo, caption=caption)
+        if isinstance(photo, bytes):
+            self.remember_file_id(digest, sent_message)
+
+    def submit(self, message, prompt, caption, error):
+        """Generate and send in the background; False if too many are queued."""
+        if not self.slots.acquire(blocking=False):
+            return False
+        with self.lock:
+            self.queued += 1
+
+        def job():
+            try:
+                self.send(message.chat.id, prompt, caption)
+            except Exception as e:
+                print(f"{error} fetch/send error:", e)
+                bot.reply_to(message, f"⚠ Failed to generate {error.lower()}. Try again later.")
+            finally:
+                with self.lock:
+                    self.queued -= 1
+                self.slots.release()
+
+        self.pool.submit(job)
+        return True
+
+images = ImageService(IMAGE_DIR, IMAGE_INDEX, IMAGE_CACHE_MB * 1024 * 1024)
+
+def generate_image(message, prompt, caption, error):
+    if not images.submit(message, prompt, caption, error):
+        bot.reply_to(message, "⏳ Too many images in the oven, try again in a minute")
+
 @bot.message_handler(commands=['image'])
 @check_banned_user
 def image_cmd(message):
@@ -1008,15 +2795,7 @@ def image_cmd(message):
         bot.reply_to(message, "Usage: /image <describe your image>")
         return
 
-    url = f"https://image.pollinations.ai/prompt/{prompt}"
-
-    try:
-        r = requests.get(url, timeout=45)
-        r.raise_for_status()  # make sure we got the image
-        bot.send_photo(message.chat.id, photo=BytesIO(r.content), caption="🖼 AI Generated Image")
-    except Exception as e:
-        print("Image fetch/send error:", e)
-        bot.reply_to(message, "⚠ Failed to generate image. Try again later.")
+    generate_image(message, prompt, "🖼 AI Generated Image", "Image")
 
 @bot.message_handler(commands=['logo'])
 @check_banned_user
@@ -1026,16 +2805,7 @@ def logo_cmd(message):
         bot.reply_to(message, "Usage: /logo <brand description>")
         return
 
-    prompt = "logo design " + prompt
-    url = f"https://image.pollinations.ai/prompt/{prompt}"
-
-    try:
-        r = requests.get(url, timeout=45)
-        r.raise_for_status()
-        bot.send_photo(message.chat.id, photo=BytesIO(r.content), caption="🎨 AI Generated Logo")
-    except Exception as e:
-        print("Logo fetch/send error:", e)
-        bot.reply_to(message, "⚠ Failed to generate logo. Try again later.")
+    generate_image(message, "logo design " + prompt, "🎨 AI Generated Logo", "Logo")
 
 # ---------------- ANIME GUIDE COMMAND ---------------- #
 @bot.message_handler(commands=['anime'])
@@ -1109,11 +2879,9 @@ def search_character(message):
     # Wait for answer
     def recruit_handler(reply):
         text = reply.text.lower()
-        data = load_anime()
 
         if text == "yes":
-            data[str(uid)]["characters"].append(character)
-            save_anime(data)
+            anime_store.add_character(uid, character)
             bot.reply_to(reply, f"✅ {name} added to your squad!")
         else:
             bot.reply_to(reply, f"❌ {name} rejected.")
@@ -1131,8 +2899,7 @@ def show_characters(message):
     add_command_xp(user)
     ensure_anime_user(uid)
 
-    data = load_anime()
-    squad = data.get(uid, {}).get("characters", [])
+    squad = anime_store.squad(uid)
 
     if not squad:
         bot.reply_to(message, "😅 You haven't recruited any characters yet. Use /search <anime verse> to find some!")
@@ -1145,9 +2912,6 @@ def show_characters(message):
     bot.reply_to(message, text)
 
 # ---------------- TRAIN COMMAND ---------------- #
-TRAIN_COOLDOWN = 3600  # 1 hour in seconds
-last_train = {}  # stores uid: timestamp of last train
-
 @bot.message_handler(commands=["train"])
 @check_banned_user
 def train_characters(message):
@@ -1156,27 +2920,20 @@ def train_characters(message):
     add_command_xp(user)
     ensure_anime_user(uid)
 
-    data = load_anime()
-    squad = data.get(uid, {}).get("characters", [])
+    squad = anime_store.squad(uid)
 
     if not squad:
         bot.reply_to(message, "😅 You have no characters to train. Use /search <anime verse> first!")
         return
 
-    now = time.time()
-    last = last_train.get(uid, 0)
-    if now - last < TRAIN_COOLDOWN:
-        remaining = int(TRAIN_COOLDOWN - (now - last))
+    if not can_train(uid):
+        remaining = int(TRAIN_COOLDOWN - (time.time() - anime_store.last_train(uid)))
         mins, secs = divmod(remaining, 60)
         bot.reply_to(message, f"⏳ You need to wait {mins}m {secs}s before training again.")
         return
 
     # Train all characters +2 levels
-    for c in squad:
-        c["level"] += 2
-
-    last_train[uid] = now
-    save_anime(data)
+    anime_store.train(uid, 2)
     bot.reply_to(message, f"💪 Your squad trained! All characters gained 2 levels. Come back in 1 hour for more.")
 
 # ---------------- REMOVE CHARACTER ---------------- #
@@ -1188,8 +2945,7 @@ def remove_character(message):
     add_command_xp(user)
     ensure_anime_user(uid)
 
-    data = load_anime()
-    squad = data.get(uid, {}).get("characters", [])
+    squad = anime_store.squad(uid)
 
     if not squad:
         bot.reply_to(message, "😅 You have no characters to remove.")
@@ -1206,12 +2962,10 @@ def remove_character(message):
         return
 
     # Find character
-    for c in squad:
-        if c["name"].lower() == char_name:
-            squad.remove(c)
-            save_anime(data)
-            bot.reply_to(message, f"🗑 {c['name']} removed from your squad.")
-            return
+    removed = anime_store.remove_character(uid, char_name)
+    if removed:
+        bot.reply_to(message, f"🗑 {removed['name']} removed from your squad.")
+        return
 
     bot.reply_to(message, f"❌ Character '{char_name}' not found in your squad.")
 
@@ -1222,40 +2976,18 @@ def squad_leaderboard(message):
     user = message.from_user.username
     add_command_xp(user)
 
-    data = load_anime()  # your anime data file with all users' characters
-    if not data:
-        bot.reply_to(message, "No squads recruited yet 😅 Go search some anime heroes first!")
-        return
-
-    # Calculate strength per user
-    rarity_bonus = {"Common": 1, "Rare": 3, "Legendary": 7}
-    leaderboard = []
-
-    for uid, info in data.items():
-        characters = info.get("characters", [])
-        if not characters:
-            continue
-
-        strength = sum(char["level"] + rarity_bonus.get(char["rarity"], 0) for char in characters)
-
-        try:
-            user_obj = bot.get_chat(uid)  # fetch real Telegram user
-            username = f"@{user_obj.username}" if user_obj.username else user_obj.first_name
-        except Exception:
-            username = f"User{uid}"  # fallback
-
-        leaderboard.append((username, strength, characters))
+    # Strongest squads come straight from the store's strength index
+    top = anime_store.top(10)
+    names = resolve_names((uid for uid, _, _ in top), fallback="User{}")
+    leaderboard = [(names[uid], strength, characters) for uid, strength, characters in top]
 
     if not leaderboard:
         bot.reply_to(message, "No squads recruited yet 😅 Go search some anime heroes first!")
         return
 
-    # Sort top 10
-    top = sorted(leaderboard, key=lambda x: x[1], reverse=True)[:10]
-
     # Build leaderboard message
     text = "🏆 *SQUAD LEADERBOARD* 🏆\n\n"
-    for rank, (username, strength, chars) in enumerate(top, 1):
+    for rank, (username, strength, chars) in enumerate(leaderboard, 1):
         text += f"*{rank}. {username} — Strength: {strength}* 💥\n"
         for c in chars:
             emoji = "✨" if c["rarity"] == "Rare" else "🌟" if c["rarity"] == "Legendary" else "⚔"
@@ -1266,6 +2998,97 @@ def squad_leaderboard(message):
 
     bot.send_message(message.chat.id, text, parse_mode="Markdown")
 
+# ---------------- TRANSLATION ---------------- #
+# One GoogleTranslator per target language (it keeps request state, so each
+# has its own lock), an LRU of (line, lang) results, and several lines sent
+# as one newline-joined request instead of one request per line.
+TRANSLATE_CACHE_SIZE = 5000
+TRANSLATE_TIMEOUT = 15   # seconds the handler waits for an answer
+TRANSLATE_WORKERS = 4
+TRANSLATE_MAX_CHARS = 4500  # Google rejects requests over 5000 chars
+
+class TranslationService:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.translators = {}       # lang -> (GoogleTranslator, Lock)
+        self.cache = OrderedDict()  # (text, lang) -> translation
+        self.pool = ThreadPoolExecutor(max_workers=TRANSLATE_WORKERS)
+        self.hits = self.misses = 0
+
+    def _translator(self, lang):
+        from deep_translator import GoogleTranslator
+        from deep_translator.exceptions import LanguageNotSupportedException
+
+        with self.lock:
+            if lang not in self.translators:
+                try:
+                    translator = GoogleTranslator(source="auto", target=lang)
+                except LanguageNotSupportedException as e:
+                    raise ValueError(f"unsupported language {lang!r}") from e
+                self.translators[lang] = (translator, threading.Lock())
+            return self.translators[lang]
+
+    def _request(self, lang, lines):
+        translator, lock = self._translator(lang)
+        started = time.time()
+        try:
+            with lock:
+                return self._send(translator, lines)
+        finally:
+            http_latency.setdefault("translate.google.com", LatencyHistogram()).observe(time.time() - started)
+
+    @staticmethod
+    def _send(translator, lines):
+        if len(lines) == 1:
+            return [translator.translate(lines[0])]
+        parts = translator.translate("\n".join(lines)).split("\n")
+        if len(parts) == len(lines):
+            return parts
+        # Google merged or split lines, do them one by one
+        return [translator.translate(line) for line in lines]
+
+    def _packs(self, lines):
+        pack, size = [], 0
+        for line in lines:
+            if pack and size + len(line) + 1 > TRANSLATE_MAX_CHARS:
+                yield pack
+                pack, size = [], 0
+            pack.append(line)
+            size += len(line) + 1
+        if pack:
+            yield pack
+
+    def translate_many(self, lines, lang):
+        lang = lang.lower()
+        results, missing = {}, []
+        with self.lock:
+            for line in lines:
+                hit = self.cache.get((line, lang))
+                if hit is not None or not line.strip():
+                    results[line] = hit if hit is not None else line
+                    if hit is not None:
+                        self.cache.move_to_end((line, lang))
+                        self.hits += 1
+                elif line not in missing:
+                    missing.append(line)
+            self.misses += len(missing)
+
+        for pack in self._packs(missing):
+            for line, translated in zip(pack, self._request(lang, pack)):
+                results[line] = translated
+                with self.lock:
+                    self.cache[(line, lang)] = translated
+                    if len(self.cache) > TRANSLATE_CACHE_SIZE:
+                        self.cache.popitem(last=False)
+        return [results[line] for line in lines]
+
+    def translate(self, text, lang, timeout=TRANSLATE_TIMEOUT):
+        """Translate off the calling thread; raises FutureTimeout if it takes too long."""
+        future = self.pool.submit(self.translate_many, text.split("\n"), lang)
+        return "\n".join(future.result(timeout=timeout))
+
+translator = TranslationService()
+
 @bot.message_handler(commands=['translate'])
 @check_banned_user
 def translate_text(message):
@@ -1275,15 +3098,169 @@ def translate_text(message):
         parts = message.text.split(maxsplit=2)
         lang, text = parts[1], parts[2]
 
-        translated = GoogleTranslator(
-            source='auto',
-            target=lang
-        ).translate(text)
+        translated = translator.translate(text, lang)
 
         bot.reply_to(message, f"🌐 {translated}")
 
-    except:
+    except FutureTimeout:
+        bot.reply_to(message, "⌛ Translation is taking too long, try again later")
+    except (IndexError, ValueError):
         bot.reply_to(message, "Usage: /translate <lang> <text>")
+    except Exception as e:
+        print(f"Translate error: {e}")
+        bot.reply_to(message, "⚠ Translation failed. Try again later.")
+
+# ---------------- DICTIONARY ---------------- #
+# Fetched entries live in their own SQLite file with a TTL, the hottest
+# ones also in memory. If the API is down an expired entry is still served.
+DICTIONARY_DB = "data/dictionary.db"
+DEFINE_TTL = 30 * 24 * 3600
+DEFINE_MISS_TTL = 24 * 3600
+DEFINE_MEMORY_SIZE = 2000
+DEFINE_WARM = 200  # most-looked-up words loaded (and refreshed) at startup
+DEFINE_HITS_INTERVAL = 60  # seconds between writes of the hit counters
+
+class Dictionary:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS words "
+            "(word TEXT PRIMARY KEY, senses TEXT, fetched REAL, hits INTEGER DEFAULT 0)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS words_hits ON words (hits DESC)")
+        self.memory = OrderedDict()  # word -> (senses, fetched)
+        self.hits = {}  # word -> lookups not yet added to the table
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def _remember(self, word, senses, fetched):
+        self.memory[word] = (senses, fetched)
+        self.memory.move_to_end(word)
+        if len(self.memory) > DEFINE_MEMORY_SIZE:
+            self.memory.popitem(last=False)
+
+    def _cached(self, word):
+        with self.lock:
+            if word in self.memory:
+                self.memory.move_to_end(word)
+                return self.memory[word]
+            row = self.conn.execute(
+                "SELECT senses, fetched FROM words WHERE word = ?", (word,)
+            ).fetchone()
+            if row:
+                self._remember(word, json.loads(row[0]), row[1])
+                return self.memory[word]
+        return None
+
+    @staticmethod
+    def fetch(word):
+        """[{pos, definition, example}] from the API, [] if the word is unknown."""
+        res = http_call("dictionary", "GET", f"https://api.dictionaryapi.dev/api/v2/entries/en/{word}")
+        if res.status_code == 404:
+            return []
+        res.raise_for_status()
+        return [
+            {"pos": meaning.get("partOfSpeech", ""), "definition": d["definition"], "example": d.get("example")}
+            for entry in res.json()
+            for meaning in entry.get("meanings", [])
+            for d in meaning.get("definitions", [])
+        ]
+
+    def _store(self, word, senses):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO words (word, senses, fetched) VALUES (?, ?, ?) "
+                "ON CONFLICT(word) DO UPDATE SET senses = excluded.senses, fetched = excluded.fetched",
+                (word, json.dumps(senses), now),
+            )
+            self.conn.commit()
+            self._remember(word, senses, now)
+
+    def _count(self, word):
+        with self.lock:
+            self.hits[word] = self.hits.get(word, 0) + 1
+
+    def flush_hits(self):
+        """Add the counted lookups to the table in one transaction."""
+        with self.lock:
+            if not self.hits:
+                return
+            batch, self.hits = self.hits, {}
+            self.conn.executemany(
+                "UPDATE words SET hits = hits + ? WHERE word = ?",
+                [(n, word) for word, n in batch.items()],
+            )
+            self.conn.commit()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(DEFINE_HITS_INTERVAL)
+            try:
+                self.flush_hits()
+            except Exception as e:
+                print(f"Dictionary hits error: {e}")
+
+    def lookup(self, word, count=True):
+        """Senses for word (maybe stale if the API is down), or None if unknown/unreachable."""
+        word = word.strip().lower()
+        cached = self._cached(word)
+        if cached:
+            senses, fetched = cached
+            ttl = DEFINE_TTL if senses else DEFINE_MISS_TTL
+            if time.time() - fetched < ttl:
+                if count:
+                    self._count(word)
+                return senses
+        try:
+            senses = self.fetch(word)
+        except Exception as e:
+            print(f"Dictionary error: {e}")
+            return cached[0] if cached else None
+        self._store(word, senses)
+        if count:
+            self._count(word)
+        return senses
+
+    def warm(self):
+        """Load the most-requested words into memory, refreshing expired ones."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT word, senses, fetched FROM words ORDER BY hits DESC LIMIT ?", (DEFINE_WARM,)
+            ).fetchall()
+            for word, senses, fetched in rows:
+                self._remember(word, json.loads(senses), fetched)
+        for word, senses, fetched in rows:
+            if senses != "[]" and time.time() - fetched > DEFINE_TTL:
+                try:
+                    self._store(word, self.fetch(word))
+                except Exception:
+                    pass  # keep the stale copy
+
+dictionary = Dictionary(DICTIONARY_DB)
+shutdown_hooks.append(dictionary.flush_hits)
+
+def sense_page(word, senses, index):
+    """Text and ◀ n/N ▶ buttons for one sense of word."""
+    sense = senses[index]
+    text = f"📖 {word}"
+    if sense["pos"]:
+        text += f" ({sense['pos']})"
+    text += f": {sense['definition']}"
+    if sense.get("example"):
+        text += f"\n💬 {sense['example']}"
+
+    markup = None
+    data = f"def:{index}:{word}"
+    if len(senses) > 1 and len(data.encode()) + 4 <= 64:  # Telegram caps callback_data at 64 bytes
+        markup = InlineKeyboardMarkup()
+        markup.row(
+            InlineKeyboardButton("◀", callback_data=f"def:{(index - 1) % len(senses)}:{word}"),
+            InlineKeyboardButton(f"{index + 1}/{len(senses)}", callback_data="def_noop"),
+            InlineKeyboardButton("▶", callback_data=f"def:{(index + 1) % len(senses)}:{word}"),
+        )
+    return text, markup
 
 @bot.message_handler(commands=['define'])
 @check_banned_user
@@ -1291,16 +3268,129 @@ def define_word(message):
     add_command_xp(message.from_user.username)
 
     try:
-        word = message.text.split(maxsplit=1)[1]
-        res = requests.get(f"https://api.dictionaryapi.dev/api/v2/entries/en/{word}")
-
-        if res.status_code==200:
-            meaning = res.json()[0]["meanings"][0]["definitions"][0]["definition"]
-            bot.reply_to(message,f"📖 {word}: {meaning}")
-        else:
-            bot.reply_to(message,"Word not found")
-    except:
+        word = message.text.split(maxsplit=1)[1].strip().lower()
+    except IndexError:
         bot.reply_to(message,"Usage: /define <word>")
+        return
+
+    senses = dictionary.lookup(word)
+    if senses is None:
+        bot.reply_to(message,"⚠ Dictionary isn't answering right now. Try again later.")
+    elif not senses:
+        bot.reply_to(message,"Word not found")
+    else:
+        text, markup = sense_page(word, senses, 0)
+        bot.reply_to(message, text, reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(("def:", "def_noop")))
+@check_banned_callback
+def define_page(call):
+    if call.data == "def_noop":
+        bot.answer_callback_query(call.id)
+        return
+    _, index, word = call.data.split(":", 2)
+    senses = dictionary.lookup(word, count=False) or []
+    if not senses:
+        bot.answer_callback_query(call.id, "⚠ Definition unavailable")
+        return
+    text, markup = sense_page(word, senses, int(index) % len(senses))
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    bot.answer_callback_query(call.id)
+
+# ---------------- REMINDERS ---------------- #
+REMINDERS_FILE = "data/reminders.json"
+
+class ReminderScheduler:
+    """Every pending reminder in one min-heap, served by a single thread.
+
+    Reminders are saved to REMINDERS_FILE and reloaded on startup; ones that
+    came due while the bot was down fire straight away and count as late.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.cond = threading.Condition()
+        saved = load_json(file, {})
+        self.next_id = saved.get("next_id", 1)
+        self.reminders = {r["id"]: r for r in saved.get("reminders", [])}
+        self.heap = [(r["due"], r["id"]) for r in self.reminders.values()]
+        heapq.heapify(self.heap)
+        self.stats = {"fired": 0, "late": 0, "lateness_total": 0.0, "lateness_max": 0.0}
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _save(self):
+        save_json(self.file, {"next_id": self.next_id, "reminders": list(self.reminders.values())})
+
+    def add(self, chat_id, user_id, delay, text):
+        with self.cond:
+            rid = self.next_id
+            self.next_id += 1
+            self.reminders[rid] = {
+                "id": rid,
+                "chat_id": chat_id,
+                "user_id": user_id,
+                "due": time.time() + delay,
+                "text": text,
+            }
+            heapq.heappush(self.heap, (self.reminders[rid]["due"], rid))
+            self._save()
+            self.cond.notify()
+        return rid
+
+    def cancel(self, rid, user_id):
+        """Cancel one of `user_id`'s reminders; the heap entry is skipped later."""
+        with self.cond:
+            reminder = self.reminders.get(rid)
+            if not reminder or reminder["user_id"] != user_id:
+                return False
+            del self.reminders[rid]
+            self._save()
+            return True
+
+    def pending(self, user_id):
+        with self.cond:
+            mine = [r for r in self.reminders.values() if r["user_id"] == user_id]
+        return sorted(mine, key=lambda r: r["due"])
+
+    def _next_due(self):
+        """Block until a reminder is due, then pop and return it."""
+        with self.cond:
+            while True:
+                # Drop cancelled reminders sitting at the top
+                while self.heap and self.heap[0][1] not in self.reminders:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+
+                due, rid = self.heap[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+
+                heapq.heappop(self.heap)
+                reminder = self.reminders.pop(rid)
+                self._save()
+                return reminder
+
+    def _run(self):
+        while True:
+            reminder = self._next_due()
+            lateness = max(0.0, time.time() - reminder["due"])
+            self.stats["fired"] += 1
+            self.stats["lateness_total"] += lateness
+            self.stats["lateness_max"] = max(self.stats["lateness_max"], lateness)
+            if lateness > 5:
+                self.stats["late"] += 1
+            try:
+                bot.send_message(reminder["chat_id"], f"🔔 Reminder: {reminder['text']}")
+            except Exception as e:
+                print(f"Reminder {reminder['id']} failed: {e}")
+
+reminders = ReminderScheduler(REMINDERS_FILE)
 
 @bot.message_handler(commands=['remind'])
 @check_banned_user
@@ -1311,17 +3401,43 @@ def set_reminder(message):
         parts = message.text.split(maxsplit=2)
         mins = int(parts[1])
         text = parts[2]
+        if mins <= 0:
+            raise ValueError("minutes must be positive")
 
-        bot.reply_to(message,f"⏰ Reminder set for {mins} minutes")
-
-        def remind():
-            time.sleep(mins*60)
-            bot.send_message(message.chat.id,f"🔔 Reminder: {text}")
-
-        threading.Thread(target=remind).start()
+        rid = reminders.add(message.chat.id, message.from_user.id, mins * 60, text)
+        bot.reply_to(message,f"⏰ Reminder #{rid} set for {mins} minutes")
     except:
         bot.reply_to(message,"Usage: /remind <minutes> <text>")
 
+@bot.message_handler(commands=['reminders'])
+@check_banned_user
+def list_reminders(message):
+    mine = reminders.pending(message.from_user.id)
+    if not mine:
+        bot.reply_to(message, "No pending reminders ⏰")
+        return
+
+    text = "⏰ Your reminders:\n\n"
+    for r in mine:
+        mins = max(0, int((r["due"] - time.time() + 59) // 60))
+        text += f"#{r['id']} in {mins}m — {r['text']}\n"
+    text += "\nCancel with /cancelremind <id>"
+    bot.reply_to(message, text)
+
+@bot.message_handler(commands=['cancelremind'])
+@check_banned_user
+def cancel_reminder(message):
+    try:
+        rid = int(message.text.split()[1].lstrip("#"))
+    except (IndexError, ValueError):
+        bot.reply_to(message, "Usage: /cancelremind <id>")
+        return
+
+    if reminders.cancel(rid, message.from_user.id):
+        bot.reply_to(message, f"🗑 Reminder #{rid} cancelled")
+    else:
+        bot.reply_to(message, f"⚠ No reminder #{rid} found")
+
 @bot.message_handler(commands=['rps'])
 @check_banned_user
 def rps_game(message):
@@ -1347,47 +3463,121 @@ def rps_game(message):
         bot.reply_to(message,"Usage: /rps <rock|paper|scissors>")
 
 # ---------------- AZLYRICS FETCHER FIX ---------------- #
-def fetch_azlyrics(artist: str, title: str) -> Optional[str]:
-    """
-    Scrapes AZLyrics for given artist and title.
-    Returns lyrics string or None if not found.
-    """
-    try:
-        # Clean artist/title for URL
-        artist_clean = re.sub(r"[^a-zA-Z0-9]", "", artist.lower())
-        title_clean = re.sub(r"[^a-zA-Z0-9]", "", title.lower())
-        url = f"https://www.azlyrics.com/lyrics/{artist_clean}/{title_clean}.html"
-
-        headers = {
-            "User-Agent": (
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-            )
-        }
+AZLYRICS_URL = "https://www.azlyrics.com/lyrics/"
+LYRICS_MISS_TTL = 24 * 3600  # "not found" is remembered for a day, lyrics until evicted
+LYRICS_CACHE_SIZE = 2000  # songs kept, the least recently asked for go first
 
-        res = requests.get(url, headers=headers, timeout=10)
-        if res.status_code != 200:
-            return None
+# "artist|title" -> {"lyrics": str | None, "at": ts}, see load_data(). Kept in
+# recency order (oldest first) so the dict doubles as the LRU.
+lyrics_cache = None
+lyrics_lock = threading.Lock()
 
-        soup = BeautifulSoup(res.text, "html.parser")
+class LyricsExtractor(HTMLParser):
+    """Grabs the text of the first <div> after <div class="ringtone">.
 
-        # Lyrics div is after <div class="ringtone">, no class/id itself
-        divs = soup.find_all("div")
-        lyrics_div = None
-        for i, div in enumerate(divs):
-            if 'class' in div.attrs and div['class'] == ['ringtone']:
-                lyrics_div = divs[i + 1]
-                break
+    Lyrics div is after <div class="ringtone">, no class/id itself. Once it
+    closes we stop, so the rest of the page is never parsed.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.after_ringtone = False
+        self.depth = 0  # div nesting inside the lyrics div
+        self.lines = []
+        self.done = False
 
-        if not lyrics_div:
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == "br" and self.depth:
+            self.lines.append("\n")
+        if tag != "div":
+            return
+        if self.depth:
+            self.depth += 1
+        elif self.after_ringtone:
+            self.depth = 1
+        elif ("class", "ringtone") in attrs:
+            self.after_ringtone = True
+
+    def handle_endtag(self, tag):
+        if tag == "div" and self.depth:
+            self.depth -= 1
+            if not self.depth:
+                self.done = True
+
+    def handle_data(self, data):
+        if self.depth:
+            self.lines.append(data)
+
+    def extract(self, html, chunk_size=8192):
+        start = html.find('class="ringtone"')
+        if start == -1:
             return None
+        html = html[html.rfind("<", 0, start):]
+        for i in range(0, len(html), chunk_size):
+            self.feed(html[i:i + chunk_size])
+            if self.done:
+                break
+        lines = (line.strip() for line in "".join(self.lines).splitlines())
+        return "\n".join(line for line in lines if line) or None
+
+def lyrics_key(artist, title):
+    clean = lambda s: re.sub(r"[^a-z0-9]", "", s.lower())
+    return clean(artist), clean(title)
+
+def fetch_azlyrics(artist: str, title: str) -> Optional[str]:
+    """
+    Scrapes AZLyrics for given artist and title.
+    Returns lyrics string or None if not found.
+    Raises on network trouble so that isn't cached as "not found".
+    """
+    # Clean artist/title for URL
+    artist_clean, title_clean = lyrics_key(artist, title)
+    url = f"{AZLYRICS_URL}{artist_clean}/{title_clean}.html"
+
+    headers = {
+        "User-Agent": (
+            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+            "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+        )
+    }
 
-        lyrics = lyrics_div.get_text(strip=True, separator="\n")
-        return lyrics
+    res = http_call("azlyrics", "GET", url, headers=headers)
+    if res.status_code == 404:
+        return None
+    res.raise_for_status()
+    return LyricsExtractor().extract(res.text)
+
+def get_lyrics(artist, title):
+    """Cached lookup: (lyrics or None, fetched_ok)."""
+    key = "|".join(lyrics_key(artist, title))
+    with lyrics_lock:
+        hit = lyrics_cache.pop(key, None)
+        if hit:
+            lyrics_cache[key] = hit  # most recently used goes last
+    if hit and (hit["lyrics"] or time.time() - hit["at"] < LYRICS_MISS_TTL):
+        return hit["lyrics"], True
 
+    try:
+        lyrics = fetch_azlyrics(artist, title)
     except Exception as e:
         print(f"fetch_azlyrics error: {e}")
-        return None
+        return None, False
+
+    entry = {"lyrics": lyrics, "at": time.time()}
+    evicted = []
+    with lyrics_lock:
+        lyrics_cache.pop(key, None)
+        lyrics_cache[key] = entry
+        while len(lyrics_cache) > LYRICS_CACHE_SIZE:
+            oldest = next(iter(lyrics_cache))
+            del lyrics_cache[oldest]
+            evicted.append(oldest)
+    db.put("lyrics", key, entry)
+    for oldest in evicted:
+        db.delete("lyrics", oldest)
+    return lyrics, True
 
 # ---------------- LYRICS COMMAND ---------------- #
 @bot.message_handler(commands=['lyrics'])
@@ -1409,23 +3599,18 @@ def lyrics_cmd(message):
     artist, title = [x.strip() for x in parts[1].split('-', 1)]
     bot.reply_to(message, f"🔎 Searching lyrics for {artist} - {title}...")
 
-    lyrics_text = fetch_azlyrics(artist, title)
+    lyrics_text, fetched = get_lyrics(artist, title)
     if lyrics_text:
-        max_chars = 15000
-        response = lyrics_text[:max_chars]
-        if len(lyrics_text) > max_chars:
-            response += "\n…(truncated)"
-
         try:
-            bot.send_message(
-                message.chat.id,
-                f"🎤 Lyrics for {artist} - {title}:\n\n{response}"
-            )
+            for chunk in split_message(f"🎤 Lyrics for {artist} - {title}:\n\n{lyrics_text}"):
+                bot.send_message(message.chat.id, chunk)
         except Exception as e:
             print(f"send_message error: {e}")
-            bot.reply_to(message, "⚠️ Failed to send lyrics. They might be too long.")
-    else:
+            bot.reply_to(message, "⚠️ Failed to send lyrics. Try again later.")
+    elif fetched:
         bot.reply_to(message, f"❌ Lyrics not found for {artist} - {title}")
+    else:
+        bot.reply_to(message, "⚠️ Lyrics site isn't answering right now. Try again later.")
 
 # ------------------- NEW CHAT MEMBERS ------------------- #
 @bot.message_handler(content_types=['new_chat_members'])
@@ -1437,107 +3622,489 @@ def welcome_new_members(message):
         )
 
 # ------------------- PRIVATE DM HANDLER ------------------- #
-@bot.message_handler(func=lambda m: m.chat.type == 'private')
-def handle_private_dm(message):
+def dm_prompt(message):
+    """Everything a DM does before asking Groq.
+
+    Returns (prompt, cache kind) for Groq, or None if the message has
+    already been answered (ban, admin login, bad words...).
+    """
     user = message.from_user.username
     uid = str(message.from_user.id)
     chat_id = message.chat.id
+    remember_user(message.from_user)
 
     # ---- First Message Bonus ---- #
     if uid not in referrals_data:
         referrals_data[uid] = {"referrals": [], "coins": 2}
         bot.send_message(chat_id, "🎉 Welcome! First message bonus: +2 coins")
-        save_referrals()
+        save_referrals(uid)
 
     # ---- Hard Block ---- #
-    if user in banned_users:
+    if identity.is_banned(uid):
         bot.reply_to(message, "🚫 You have been banned")
-        return
+        return None
 
     # ---- Admin Unlock ---- #
     if admin_wait.get(chat_id):
         if message.text == ADMIN_PASSWORD:
-            admins.add(chat_id)
-            save_json(ADMINS_FILE, list(admins))
+            identity.add_admin(chat_id)
             bot.reply_to(chat_id, "✅ Admin unlocked")
         else:
             bot.reply_to(chat_id, "❌ Wrong password")
         admin_wait.pop(chat_id)
-        return
+        return None
 
     # ---- Normal Bot Flow ---- #
-    log_user(message)
+    log_user(message, "dm")
     update_memory(message)
     ensure_user(user)
     add_message_xp(user)
 
     # ---- Summarize Mode ---- #
-    if summarize_mode.get(user):
-        ans = ask_groq(user, f"Summarize:\n{message.text}")
-        bot.reply_to(message, ans)
-        summarize_mode.pop(user)
-        return
+    if summarize_mode.pop(user, None):
+        return f"Summarize:\n{message.text}", "summary"
 
     # ---- Bad Word Filter ---- #
     bad_words = ["hack", "ddos", "malware", "exploit", "crack"]
     if any(word in message.text.lower() for word in bad_words):
         bot.reply_to(message, "Ethical cyber only 👨‍💻")
+        return None
+
+    return message.text, "chat"
+
+@instrument
+def process_private_dm(message, started=None):
+    started = started or time.time()
+    request = dm_prompt(message)
+    if request:
+        # ---- GROQ AI Response ---- #
+        prompt, kind = request
+        if GROQ_STREAM:
+            reply_streaming(message, prompt, kind, started)
+            return
+        ans = ask_groq(message.from_user.username, prompt, kind)
+        bot.reply_to(message, ans)
+
+# ------------------- DM DISPATCH ------------------- #
+# DMs are handed to a worker pool so one slow Groq answer doesn't hold up
+# everyone else. Each user always lands on the same worker, so their
+# messages are still answered in order. A full queue blocks the poller for
+# up to DM_QUEUE_TIMEOUT (backpressure) and then the user is told to wait.
+DM_WORKERS = int(os.getenv("DM_WORKERS", "8"))
+DM_QUEUE_SIZE = 50        # per worker
+DM_QUEUE_TIMEOUT = 2      # seconds
+
+class KeyedDispatcher:
+    """Worker pool that runs jobs with the same key one after another."""
+
+    def __init__(self, workers, queue_size):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.wait_time = LatencyHistogram()
+        self.service_time = {}  # handler name -> LatencyHistogram
+        self.rejected = 0
+        for q in self.queues:
+            threading.Thread(target=self._work, args=(q,), daemon=True).start()
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def submit(self, key, func, *args, timeout=DM_QUEUE_TIMEOUT):
+        """Queue func(*args) behind earlier jobs for `key`. False if the queue stayed full."""
+        q = self.queues[hash(key) % len(self.queues)]
+        try:
+            q.put((time.time(), func, args), timeout=timeout)
+            return True
+        except queue.Full:
+            self.rejected += 1
+            return False
+
+    def _work(self, q):
+        while True:
+            queued_at, func, args = q.get()
+            started = time.time()
+            self.wait_time.observe(started - queued_at)
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"⚠ {func.__name__} error: {e}")
+            finally:
+                hist = self.service_time.setdefault(func.__name__, LatencyHistogram())
+                hist.observe(time.time() - started)
+
+dm_dispatcher = KeyedDispatcher(DM_WORKERS, DM_QUEUE_SIZE)
+
+def dispatch_dm(message):
+    uid = message.from_user.id
+    notice = None if identity.is_admin(uid) else throttled(uid, "dm")
+    if notice is not None:
+        if notice:
+            bot.reply_to(message, notice)
         return
+    if not dm_dispatcher.submit(message.from_user.id, process_private_dm, message, time.time()):
+        bot.reply_to(message, "⏳ I'm a bit swamped right now, try again in a moment")
+
+def is_plain_dm(message):
+    return (
+        message.chat.type == "private"
+        and message.content_type == "text"
+        and not message.text.startswith("/")
+        and message.chat.id not in bot.next_step_backend.handlers
+    )
 
-    # ---- GROQ AI Response ---- #
-    ans = ask_groq(user, message.text)
-    bot.reply_to(message, ans)
+# telebot runs handlers on its own thread pool, which can reorder two
+# messages from the same user. Plain DMs are peeled off here instead, on the
+# polling thread, while they are still in update order.
+process_other_messages = bot.process_new_messages
+
+def route_new_messages(new_messages):
+    rest = []
+    for message in new_messages:
+        if is_plain_dm(message):
+            dispatch_dm(message)
+        else:
+            rest.append(message)
+    if rest:
+        process_other_messages(rest)
+
+bot.process_new_messages = route_new_messages
+
+@bot.message_handler(func=lambda m: m.chat.type == 'private')
+def handle_private_dm(message):
+    dispatch_dm(message)
 
 # ------------------- GROUP LINK MODERATION ------------------- #
-@bot.message_handler(func=lambda m: m.chat.type != 'private')
+# Links are spotted locally first (regex + Telegram's own url entities), so
+# the admin lookup only happens for actual offenders, and then from a
+# per-chat cache of get_chat_administrators.
+LINK_RE = re.compile(r"https?://|www\.|t\.me/|\.com\b", re.IGNORECASE)
+LINK_ENTITIES = {"url", "text_link"}
+ADMIN_CACHE_TTL = 600        # seconds before a chat's admin list is refetched
+WARNING_RESET = 7 * 24 * 3600  # warnings older than this start over
+MODERATED_CONTENT = ["text", "photo", "video", "document", "animation", "audio", "voice"]
+
+chat_admins = {}  # chat_id -> (set of admin user ids, fetched_at)
+link_warnings = None  # {chat: {user: {count, timestamp}}}, see load_data()
+warnings_lock = threading.Lock()
+
+def has_link(message):
+    text = message.text or message.caption or ""
+    entities = message.entities or message.caption_entities or []
+    return any(e.type in LINK_ENTITIES for e in entities) or bool(LINK_RE.search(text))
+
+def is_chat_admin(chat_id, user_id):
+    cached = chat_admins.get(chat_id)
+    if not cached or time.time() - cached[1] > ADMIN_CACHE_TTL:
+        try:
+            members = bot.get_chat_administrators(chat_id)
+        except Exception as e:
+            print(f"Failed to get admins for {chat_id}: {e}")
+            return False
+        cached = chat_admins[chat_id] = ({m.user.id for m in members}, time.time())
+    return user_id in cached[0]
+
+def add_link_warning(chat_id, user_id):
+    """Bump and persist a user's warning count in a chat; returns the new count."""
+    now = time.time()
+    with warnings_lock:
+        chat_warnings = link_warnings.setdefault(str(chat_id), {})
+        entry = chat_warnings.get(str(user_id))
+        if not entry or now - entry["timestamp"] > WARNING_RESET:
+            entry = {"count": 0, "timestamp": now}
+        entry["count"] += 1
+        entry["timestamp"] = now
+        chat_warnings[str(user_id)] = entry
+        save_json(WARNINGS_FILE, link_warnings, indent=4)
+        return entry["count"]
+
+def reset_link_warnings(chat_id, user_id):
+    with warnings_lock:
+        link_warnings.get(str(chat_id), {}).pop(str(user_id), None)
+        save_json(WARNINGS_FILE, link_warnings, indent=4)
+
+@bot.message_handler(func=lambda m: m.chat.type != 'private', content_types=MODERATED_CONTENT)
+@instrument
 def group_link_moderation(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
+    remember_user(message.from_user)
 
-    # Check if user is admin
-    try:
-        member = bot.get_chat_member(chat_id, user_id)
-        is_admin = member.status in ['administrator', 'creator']
-    except:
-        is_admin = False
+    # Detect links
+    if not has_link(message):
+        return
 
-    if is_admin:
+    # Admins may post links
+    if is_chat_admin(chat_id, user_id):
         return
 
-    # Detect links
-    if any(x in message.text.lower() for x in ["http://", "https://", ".com"]):
-        # Delete the offending message
+    # Delete the offending message
+    try:
+        bot.delete_message(chat_id, message.message_id)
+    except Exception as e:
+        print(f"Failed to delete message: {e}")
+
+    # Track warnings
+    warning_count = add_link_warning(chat_id, user_id)
+
+    # Send warning messages
+    name = display_name(message.from_user)
+    if warning_count == 1:
+        bot.send_message(chat_id, f"⚠️ Warning 1: Links are not allowed, {name}!")
+    elif warning_count == 2:
+        bot.send_message(chat_id, f"⚠️ Warning 2: Second time posting links. Next time you'll be muted, {name}!")
+    elif warning_count >= 3:
+        until_date = int(time.time() + 24*3600)
+        bot.restrict_chat_member(chat_id, user_id, can_send_messages=False, until_date=until_date)
+        bot.send_message(chat_id, f"🚫 {name} has been muted for 24 hours for posting links!")
+        reset_link_warnings(chat_id, user_id)
+
+
+# ---------------- ASYNC MODE ---------------- #
+# BOT_MODE=async: AsyncTeleBot does the polling, and the slow network-bound
+# paths (AI chat, /joke, /image, /logo) run as coroutines with aiohttp, so
+# hundreds of them can be in flight on one event loop. Every other update
+# goes to the normal sync handlers in a thread, so both modes share one
+# command set.
+ASYNC_HTTP_LIMIT = 100  # max open upstream connections
+
+def run_async():
+    import asyncio
+    import aiohttp
+    from telebot.async_telebot import AsyncTeleBot
+
+    http = {}
+
+    async def fetch(service, method, url, **kwargs):
+        """aiohttp twin of http_call(): returns (status, body bytes)."""
+        connect_timeout, read_timeout, retries = HTTP_SERVICES[service]
+        breaker = http_breakers[service]
+        if not breaker.allow():
+            raise UpstreamUnavailable(service)
+
+        host = urlparse(url).netloc
+        http_session(host)  # registers the host's latency histogram
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+        for attempt in range(retries + 1):
+            started = time.time()
+            status, body, error, retry_after = None, None, None, None
+            try:
+                async with http["session"].request(method, url, timeout=timeout, **kwargs) as res:
+                    status, body = res.status, await res.read()
+                    retry_after = res.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            http_latency[host].observe(time.time() - started)
+
+            if status is not None and status < 500 and status != 429:
+                breaker.success()
+                return status, body
+            if attempt == retries:
+                break
+            delay = retry_delay(method, attempt, status, retry_after,
+                                unsent=isinstance(error, aiohttp.ClientConnectorError))
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+
+        breaker.failure()
+        if status is not None:
+            return status, body
+        raise error
+
+    async def ask(username, prompt, kind="chat"):
+        payload = groq_payload(username, prompt)
+        ttl = GROQ_CACHE_TTL.get(kind, 0)
+        key = completion_key(payload) if ttl else None
+        if key and (cached := groq_cache.get(key)):
+            return cached
+
         try:
-            bot.delete_message(chat_id, message.message_id)
+            take_groq_token()
+            _, body = await fetch(
+                "groq", "POST", GROQ_URL,
+                headers={"Authorization": f"Bearer {API_KEY}"},
+                json=payload
+            )
+            answer = json.loads(body)["choices"][0]["message"]["content"].strip()
+        except RateLimited:
+            return GROQ_BUSY
         except Exception as e:
-            print(f"Failed to delete message: {e}")
+            print("Groq error:", e)
+            return "Network error 😕"
 
-        # Track warnings
-        chat_warnings = link_warnings.setdefault(chat_id, {})
-        chat_warnings[user_id] = chat_warnings.get(user_id, 0) + 1
-        warning_count = chat_warnings[user_id]
+        if key:
+            groq_cache.put(key, answer, ttl)
+        return answer
 
-        # Send warning messages
-        if warning_count == 1:
-            bot.send_message(chat_id, f"⚠️ Warning 1: Links are not allowed, @{message.from_user.username}!")
-        elif warning_count == 2:
-            bot.send_message(chat_id, f"⚠️ Warning 2: Second time posting links. Next time you'll be muted, @{message.from_user.username}!")
-        elif warning_count >= 3:
-            until_date = int(time.time() + 24*3600)
-            bot.restrict_chat_member(chat_id, user_id, can_send_messages=False, until_date=until_date)
-            bot.send_message(chat_id, f"🚫 @{message.from_user.username} has been muted for 24 hours for posting links!")
-            chat_warnings[user_id] = 0
+    async def chat(message):
+        uid = message.from_user.id
+        notice = None if identity.is_admin(uid) else throttled(uid, "dm")
+        if notice is not None:
+            if notice:
+                await abot.reply_to(message, notice)
+            return
+        request = await asyncio.to_thread(dm_prompt, message)
+        if request:
+            prompt, kind = request
+            await abot.reply_to(message, await ask(message.from_user.username, prompt, kind))
 
+    async def joke(message):
+        if not await asyncio.to_thread(user_allowed, message):
+            return
+        add_command_xp(message.from_user.username)
+        ans = take_joke() or await ask(message.from_user.username, JOKE_PROMPT, kind="joke")
+        await abot.reply_to(message, ans)
 
-# ---------------- RUN ---------------- #
-import threading
-from flask import Flask
-import os
+    async def generate(message, prompt, caption, error):
+        try:
+            digest = images.lookup(prompt)
+            photo = images.photo(digest) if digest else None
+            if photo is None:  # not cached, or evicted since the lookup
+                status, body = await fetch("pollinations", "GET", POLLINATIONS_URL + prompt)
+                if status >= 400:
+                    raise RuntimeError(f"HTTP {status}")
+                digest = await asyncio.to_thread(images.store, prompt, body)
+                photo = images.photo(digest) or body
+            sent_message = await abot.send_photo(message.chat.id, photo=photo, caption=caption)
+            if isinstance(photo, bytes):
+                images.remember_file_id(digest, sent_message)
+        except Exception as e:
+            print(f"{error} fetch/send error:", e)
+            await abot.reply_to(message, f"⚠ Failed to generate {error.lower()}. Try again later.")
 
-print("🚀 Collins AI running...")
+    async def image(message):
+        if not await asyncio.to_thread(user_allowed, message):
+            return
+        prompt = message.text.replace("/image", "").strip()
+        if not prompt:
+            await abot.reply_to(message, "Usage: /image <describe your image>")
+            return
+        await generate(message, prompt, "🖼 AI Generated Image", "Image")
+
+    async def logo(message):
+        if not await asyncio.to_thread(user_allowed, message):
+            return
+        prompt = message.text.replace("/logo", "").strip()
+        if not prompt:
+            await abot.reply_to(message, "Usage: /logo <brand description>")
+            return
+        await generate(message, "logo design " + prompt, "🎨 AI Generated Logo", "Logo")
+
+    commands = {"joke": joke, "image": image, "logo": logo}
+
+    def async_handler(message):
+        if message is None or message.content_type != "text":
+            return None
+        if message.text.startswith("/"):
+            command = message.text.split()[0][1:].split("@")[0].lower()
+            return commands.get(command)
+        # Plain DMs, unless a next-step handler (e.g. /search recruit) is waiting
+        if message.chat.type == "private" and message.chat.id not in bot.next_step_backend.handlers:
+            return chat
+        return None
+
+    async def dispatch(update):
+        if not data_ready.is_set():
+            await asyncio.to_thread(data_ready.wait)
+        handler = async_handler(update.message)
+        if not handler:
+            try:
+                await asyncio.to_thread(bot.process_new_updates, [update])
+            except Exception as e:
+                print(f"⚠ Async handler error: {e}")
+            return
+
+        # Timed here rather than with @instrument, which can't await
+        started = time.perf_counter()
+        failed = False
+        try:
+            await handler(update.message)
+        except Exception as e:
+            failed = True
+            print(f"⚠ Async handler error: {e}")
+        finally:
+            record_handler(handler.__name__, time.perf_counter() - started, failed)
+
+    class CollinsAsyncBot(AsyncTeleBot):
+        async def process_new_updates(self, updates):
+            await asyncio.gather(*(dispatch(u) for u in updates))
+
+    abot = CollinsAsyncBot(TOKEN)
+
+    async def serve():
+        http["session"] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_HTTP_LIMIT)
+        )
+        try:
+            await abot.infinity_polling(timeout=60)
+        finally:
+            await http["session"].close()
+
+    asyncio.run(serve())
+
+# ---------------- STARTUP ---------------- #
+# The data stores load on a background thread so polling and Flask can
+# start straight away; updates wait on data_ready before any handler runs.
+data_ready = threading.Event()
+startup_times = {"imports": IMPORT_SECONDS}  # phase -> seconds since BOOT_CLOCK
+
+def load_data():
+    try:
+        _load_data()
+    except Exception as e:
+        # Handlers would wait on data_ready forever; die so the host restarts us
+        print(f"⚠ Loading data failed: {e!r}")
+        os._exit(1)
+
+def _load_data():
+    global daily_data, referrals_data, user_memory, identity, xp_data, xp_rank
+    global anime_store, memory_store, lyrics_cache, link_warnings
+    started = time.perf_counter()
+
+    daily_data = db.load("daily")
+    referrals_data = db.load("referrals")
+    user_memory = db.load("memory")
+    identity = IdentityIndex()
+    xp_data = db.load("xp")
+    xp_rank = RankIndex(
+        (u, d["xp"]) for u, d in xp_data.items() if not identity.is_banned(u)
+    )
+    anime_store = AnimeStore(ANIME_FILE, ANIME_JOURNAL)
+    shutdown_hooks.append(anime_store.compact)
+    memory_store = MemoryStore(user_memory)
+    lyrics_cache = db.load("lyrics")
+    link_warnings = load_json(WARNINGS_FILE, {})
+
+    startup_times["data"] = time.perf_counter() - BOOT_CLOCK
+    print(f"📂 Data loaded in {(time.perf_counter() - started) * 1000:.0f} ms")
+    data_ready.set()
+
+def when_ready(func):
+    """Run func on its own thread once load_data() has finished."""
+    threading.Thread(target=lambda: data_ready.wait() and func(), daemon=True).start()
+
+process_updates_now = bot.process_new_updates
+
+def process_updates_when_ready(updates):
+    data_ready.wait()
+    if "first_update" not in startup_times:
+        startup_times["first_update"] = time.perf_counter() - BOOT_CLOCK
+        print(f"⚡ First update handled {startup_times['first_update'] * 1000:.0f} ms after start")
+    process_updates_now(updates)
+
+bot.process_new_updates = process_updates_when_ready
+threading.Thread(target=load_data, daemon=True).start()
+
+def startup_report():
+    return " | ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in startup_times.items())
+
+# ---------------- RUN ---------------- #
+# BOT_MODE=polling (default), BOT_MODE=async or BOT_MODE=webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
 
 # --- Telegram bot polling in a thread ---
 def run_bot():
+    bot.remove_webhook()  # polling gets 409 Conflict while a webhook is set
     while True:
         try:
             bot.polling(non_stop=True, timeout=60)
@@ -1547,16 +4114,193 @@ def run_bot():
             print("Muhahahahaha...")
             time.sleep(5)
 
-threading.Thread(target=run_bot).start()
-
-# --- Dummy Flask server for Render free tier ---
-app = Flask(__name__)
-
-@app.route("/")
-def index():
-    return "Collins AI bot is running 🚀"
-
-port = int(os.environ.get("PORT", 10000))  # Render assigns PORT automatically
-app.run(host="0.0.0.0", port=port)
-
+# --- Flask server: Render keep-alive, /metrics and the webhook route ---
+app = None
+
+def make_app():
+    """Build the Flask app on first use; importing flask isn't free."""
+    global app
+    if app is None:
+        from flask import Flask, request
+
+        app = Flask(__name__)
+        app.add_url_rule("/", "index", lambda: "Collins AI bot is running 🚀")
+        app.add_url_rule("/metrics", "metrics", lambda: metrics(request))
+        app.add_url_rule("/webhook", "webhook", lambda: webhook(request), methods=["POST"])
+    return app
+
+# --- Prometheus metrics ---
+# Plain text exposition format, scraped from /metrics. Set METRICS_TOKEN to
+# require "Authorization: Bearer <token>".
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+def prom_histogram(lines, name, hist, labels=""):
+    sep = "," if labels else ""
+    cumulative = 0
+    for bound, n in zip(hist.buckets, hist.counts):
+        cumulative += n
+        le = "+Inf" if bound == float("inf") else bound
+        lines.append(f'{name}_bucket{{{labels}{sep}le="{le}"}} {cumulative}')
+    labels = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{labels} {hist.total:.6f}")
+    lines.append(f"{name}_count{labels} {hist.count}")
+
+def metrics_text():
+    # Every sample of a metric family has to follow its own TYPE line
+    with handler_stats_lock:
+        handlers = [(name, dict(stats)) for name, stats in sorted(handler_stats.items())]
+    lines = ["# TYPE collins_handler_calls_total counter"]
+    for name, stats in handlers:
+        lines.append(f'collins_handler_calls_total{{handler="{name}"}} {stats["calls"]}')
+    lines.append("# TYPE collins_handler_errors_total counter")
+    for name, stats in handlers:
+        lines.append(f'collins_handler_errors_total{{handler="{name}"}} {stats["errors"]}')
+    lines.append("# TYPE collins_handler_seconds histogram")
+    for name, stats in handlers:
+        prom_histogram(lines, "collins_handler_seconds", stats["latency"], f'handler="{name}"')
+
+    lines.append("# TYPE collins_upstream_seconds histogram")
+    for host, hist in sorted(http_latency.items()):
+        prom_histogram(lines, "collins_upstream_seconds", hist, f'host="{host}"')
+    lines.append("# TYPE collins_groq_first_token_seconds histogram")
+    prom_histogram(lines, "collins_groq_first_token_seconds", groq_first_token)
+    lines.append("# TYPE collins_upstream_circuit_open gauge")
+    for service, breaker in sorted(http_breakers.items()):
+        lines.append(f'collins_upstream_circuit_open{{service="{service}"}} {int(breaker.is_open())}')
+
+    depths = {
+        "dm": dm_dispatcher.depth(),
+        "webhook": webhook_dispatcher.depth() if webhook_dispatcher else 0,
+        "activity_log": activity_log.queue.qsize(),
+        "images": images.queued,
+        "persist": len(dirty_files),
+        "reminders": len(reminders.reminders),
+    }
+    lines.append("# TYPE collins_queue_depth gauge")
+    for name, depth in depths.items():
+        lines.append(f'collins_queue_depth{{queue="{name}"}} {depth}')
+    lines.append("# TYPE collins_dm_queue_wait_seconds histogram")
+    prom_histogram(lines, "collins_dm_queue_wait_seconds", dm_dispatcher.wait_time)
+
+    counters = {
+        "collins_dm_rejected_total": dm_dispatcher.rejected,
+        "collins_activity_dropped_total": activity_log.dropped,
+        "collins_rate_limited_total": rate_buckets.limited,
+        "collins_groq_budget_exhausted_total": groq_budget.limited,
+        "collins_persist_flushes_total": persist_stats["flushes"],
+        "collins_persist_files_written_total": persist_stats["files_written"],
+        "collins_persist_bytes_written_total": persist_stats["bytes_written"],
+        "collins_persist_errors_total": persist_stats["errors"],
+    }
+    for name, value in counters.items():
+        lines += [f"# TYPE {name} counter", f"{name} {value}"]
+
+    caches = {"groq": groq_cache, "images": images, "translate": translator}
+    lines.append("# TYPE collins_cache_hits_total counter")
+    for name, cache in caches.items():
+        lines.append(f'collins_cache_hits_total{{cache="{name}"}} {cache.hits}')
+    lines.append("# TYPE collins_cache_misses_total counter")
+    for name, cache in caches.items():
+        lines.append(f'collins_cache_misses_total{{cache="{name}"}} {cache.misses}')
+
+    lines += ["# TYPE collins_users gauge", f"collins_users {len(memory_store) if data_ready.is_set() else 0}"]
+    lines.append("# TYPE collins_startup_seconds gauge")
+    for phase, seconds in startup_times.items():
+        lines.append(f'collins_startup_seconds{{phase="{phase}"}} {seconds:.3f}')
+    return "\n".join(lines) + "\n"
+
+def metrics(request):
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        return "forbidden", 403
+    return metrics_text(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+def run_keepalive():
+    port = int(os.environ.get("PORT", 10000))  # Render assigns PORT automatically
+    make_app().run(host="0.0.0.0", port=port)
+
+# --- Webhook mode ---
+# Telegram POSTs updates to WEBHOOK_URL/webhook. The route only checks the
+# secret and queues the update, so Telegram gets its 200 straight away.
+# Updates for the same chat go to the same worker and stay in order. When
+# the queue is full we answer 503 and Telegram redelivers later.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # e.g. https://collins.onrender.com
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256((TOKEN or "").encode()).hexdigest()[:32]
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = 100  # per worker
+
+webhook_dispatcher = None
+
+def update_key(update):
+    for message in (update.message, update.edited_message, update.channel_post):
+        if message:
+            return message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return update.update_id
+
+def webhook(request):
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return "forbidden", 403
+    if webhook_dispatcher is None:
+        return "not ready", 503
+    try:
+        update = telebot.types.Update.de_json(request.get_data(as_text=True))
+    except Exception as e:
+        print(f"⚠ Bad webhook payload: {e}")
+        return "", 200  # don't make Telegram retry garbage
+    if not webhook_dispatcher.submit(update_key(update), bot.process_new_updates, [update], timeout=0):
+        return "busy", 503
+    return "", 200
+
+def start_services():
+    threading.Thread(target=dictionary.warm, daemon=True).start()
+    when_ready(resume_broadcast)
+    reminders.start()
+    threading.Thread(target=refill_jokes, daemon=True).start()
+
+def start_webhook():
+    global webhook_dispatcher
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_URL")
+    # Handlers run on the keyed workers themselves: updates for a chat stay
+    # in order, and a full queue turns into a 503 instead of piling up in
+    # telebot's unbounded worker pool
+    bot.threaded = False
+    webhook_dispatcher = KeyedDispatcher(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    bot.set_webhook(url=f"{WEBHOOK_URL}/webhook", secret_token=WEBHOOK_SECRET,
+                    max_connections=40)
+
+def create_app():
+    """WSGI entry point for webhook mode: gunicorn -w 1 --threads 8 'bot:create_app()'
+
+    Users, XP and squads live in this process's memory, so run a single
+    worker process and scale with threads. More processes would each keep
+    their own copy of that state and overwrite each other's saves.
+    """
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        print("⚠ WEB_CONCURRENCY > 1: bot state is per process, use one worker with --threads")
+    print("🚀 Collins AI running (webhook)...")
+    start_services()  # gunicorn owns the signals here, its worker exits cleanly and atexit flushes
+    start_webhook()
+    return make_app()
+
+def main():
+    print(f"🚀 Collins AI running ({BOT_MODE})... imports took {IMPORT_SECONDS * 1000:.0f} ms")
+    handle_signals()
+    start_services()
+
+    if BOT_MODE == "webhook":
+        start_webhook()
+        run_keepalive()
+    elif BOT_MODE == "async":
+        threading.Thread(target=run_keepalive, daemon=True).start()
+        run_async()
+    else:
+        threading.Thread(target=run_bot).start()
+        run_keepalive()
 
+if __name__ == "__main__":
+    main()